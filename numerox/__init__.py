@@ -18,6 +18,8 @@ from numerox.data import load_data, load_zip
 from numerox.testing import play_data
 from numerox.prediction import load_prediction
 from numerox.prediction import load_prediction_csv
+from numerox.prediction import load_predictions_csv
+from numerox.prediction import load_prediction_mmap
 
 # splitters
 from numerox.splitter import TournamentSplitter
@@ -27,11 +29,16 @@ from numerox.splitter import CheatSplitter
 from numerox.splitter import CVSplitter
 from numerox.splitter import IgnoreEraCVSplitter
 from numerox.splitter import RollSplitter
+from numerox.splitter import RepeatedCVSplitter
 
 # run
 from numerox.run import production
 from numerox.run import backtest
 from numerox.run import run
+from numerox.run import run_many
+from numerox.search import sweep
+from numerox.search import successive_halving
+from numerox.search import run_repeated
 
 # numerai
 from numerox.numerai import download
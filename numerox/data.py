@@ -1,4 +1,5 @@
 import zipfile
+import hashlib
 
 import numpy as np
 import pandas as pd
@@ -141,6 +142,19 @@ class Data(object):
         idx = self.df.region.isin(regions)
         return self[~idx]
 
+    def _region_view(self, regions):
+        """
+        Data containing only regions in the iterable `regions`.
+
+        A view (no copy) is returned if the rows of the regions are
+        contiguous, as they are in Numerai datasets; otherwise a copy.
+        """
+        regions = self.regions_str2int(regions)
+        idx = np.flatnonzero(self.df.region.isin(regions).values)
+        if idx.size > 0 and idx[-1] - idx[0] + 1 == idx.size:
+            return Data(self.df.iloc[idx[0]:idx[-1] + 1])
+        return Data(self.df.take(idx))
+
     def regions_str2int(self, regions):
         "List with regions names (str) converted to int"
         r = []
@@ -344,6 +358,20 @@ class Data(object):
         h = hash(b)
         return h
 
+    def digest(self):
+        """
+        md5 hex digest of the content (values and ids) of data object.
+
+        Unlike `hash` the digest is the same across computers, and the data
+        is digested in chunks of rows rather than copied as a whole.
+        """
+        digest = hashlib.md5()
+        values = self.df.values
+        for i in range(0, values.shape[0], 100000):
+            digest.update(values[i:i + 100000].tobytes())
+        digest.update('\n'.join(self.ids).encode('utf-8'))
+        return digest.hexdigest()
+
     def copy(self):
         "Copy of data"
         # df.copy(deep=True) doesn't copy index. So:
@@ -16,7 +16,7 @@ def compare_models(data):
 
     # correlation of models with logistic regression
     print('\nCorrelation:\n')
-    prediction.correlation('logistic')
+    print(prediction.correlation('logistic'))
 
     # compare performance of models
     print('\nPerformance comparison:\n')
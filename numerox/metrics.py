@@ -1,3 +1,5 @@
+from multiprocessing.pool import ThreadPool
+
 import pandas as pd
 import numpy as np
 
@@ -9,6 +11,10 @@ from numerox.data import REGION_INT_TO_STR
 
 LOGLOSS_BENCHMARK = 0.693
 
+# clusters used by concordance, keyed by data digest
+CONCORDANCE_CACHE = {}
+CONCORDANCE_CACHE_SIZE = 4
+
 
 def metrics_per_era(data, prediction, join='data',
                     columns=['logloss', 'auc', 'acc', 'ystd'],
@@ -57,9 +63,66 @@ def metrics_per_era(data, prediction, join='data',
     return metrics, regions
 
 
+def logloss_per_era(data, prediction, era_as_str=False):
+    """
+    Log loss of each name in each era as an era by name dataframe.
+
+    All names are scored together in one grouped pass over the rows of
+    `data` (rows are sorted by era once; per-era sums are then taken for
+    all names at once). Ids in `data` that are missing from `prediction`
+    give NaN. As with ``metrics_per_era`` an era gives NaN if its targets
+    contain a single class.
+    """
+    eps = 1e-15
+    yhat = _align_rows(prediction, data.df.index)
+    yhat = yhat.astype(np.float64, copy=False)
+    y = data.y
+    era = data.era_float
+    order = np.argsort(era, kind='mergesort')
+    era = era[order]
+    y = y[order][:, None]
+    yhat = np.clip(yhat[order], eps, 1 - eps)
+    starts = np.flatnonzero(np.r_[True, era[1:] != era[:-1]])
+    count = np.diff(np.r_[starts, era.size])
+    loss = -(y * np.log(yhat) + (1 - y) * np.log(1 - yhat))
+    logloss = np.add.reduceat(loss, starts, axis=0) / count[:, None]
+    ysum = np.add.reduceat(y[:, 0], starts)
+    logloss[(ysum == 0) | (ysum == count)] = np.nan
+    eras = era[starts]
+    if era_as_str:
+        eras = [ERA_INT_TO_STR[e] for e in eras]
+    return pd.DataFrame(logloss, index=eras, columns=prediction.names)
+
+
+def logloss_metrics(pivot):
+    """
+    Dataframe with names as rows and logloss, sharpe, consis as columns.
+
+    `pivot` is an era by name dataframe of logloss such as the one returned
+    by ``logloss_per_era``. The metrics are the same as those of
+    ``metrics_per_name``: NaN eras are skipped by logloss and sharpe and
+    count as losses in consis.
+    """
+    metrics = pd.DataFrame(index=pivot.columns)
+    metrics['logloss'] = pivot.mean(axis=0)
+    metrics['sharpe'] = (LOGLOSS_BENCHMARK - pivot).mean(axis=0)
+    metrics['sharpe'] /= pivot.std(axis=0)
+    metrics['consis'] = (pivot < LOGLOSS_BENCHMARK).mean(axis=0)
+    return metrics
+
+
 def metrics_per_name(data, prediction, join='data',
                      columns=['logloss', 'auc', 'acc', 'ystd'],
-                     era_as_str=True, region_as_str=True):
+                     era_as_str=True, region_as_str=True, bootstrap=None,
+                     ci=0.95, seed=0):
+    """
+    Dataframe with names as rows and specified metrics as columns. And info.
+
+    If `bootstrap` is an integer then that many resamples (with replacement)
+    of the eras are used to add `ci` confidence intervals of logloss, sharpe
+    and consis (those that are in `columns`) as columns, e.g. `sharpe_lo`
+    and `sharpe_hi`.
+    """
 
     # calc metrics per era
     skip = ['sharpe', 'consis']
@@ -111,11 +174,65 @@ def metrics_per_name(data, prediction, join='data',
             raise ValueError("unknown metric ({})".format(col))
         metrics[col] = m
 
+    if bootstrap is not None:
+        cis = bootstrap_per_name(pivot.values, bootstrap, ci=ci, seed=seed)
+        for col in ('logloss', 'sharpe', 'consis'):
+            if col in columns:
+                metrics[col + '_lo'] = cis[col][0]
+                metrics[col + '_hi'] = cis[col][1]
+
     return metrics, info
 
 
+def bootstrap_per_name(pivot, nsamples, ci=0.95, seed=0):
+    """
+    Bootstrap confidence intervals of logloss, sharpe, and consis.
+
+    `pivot` is a 2d array of logloss with eras as rows and names as columns;
+    missing values are skipped. All names are resampled at once: the eras
+    drawn in each of the `nsamples` resamples are stored as counts in a
+    single (nsamples, neras) matrix so that the resampled sums are matmuls.
+
+    Returns a dict with metric name as key and (lower, upper) tuple of
+    arrays (one element per name) as value.
+    """
+    nera = pivot.shape[0]
+    valid = np.isfinite(pivot)
+    d = np.where(valid, LOGLOSS_BENCHMARK - pivot, 0)
+
+    # counts[i, j] is the number of times era j is in resample i
+    rs = np.random.RandomState(seed)
+    idx = rs.randint(0, nera, size=(nsamples, nera))
+    idx += nera * np.arange(nsamples).reshape(-1, 1)
+    counts = np.bincount(idx.reshape(-1), minlength=nsamples * nera)
+    counts = counts.reshape(nsamples, nera).astype(np.float64)
+
+    # batched reductions
+    n = np.dot(counts, valid)
+    s1 = np.dot(counts, d)
+    s2 = np.dot(counts, d * d)
+    wins = np.dot(counts, valid & (d > 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        std = np.sqrt((s2 - n * mean * mean) / (n - 1))
+        samples = {'logloss': LOGLOSS_BENCHMARK - mean,
+                   'sharpe': mean / std,
+                   'consis': wins / n}
+
+    q = [100 * (1 - ci) / 2.0, 100 * (1 + ci) / 2.0]
+    cis = {}
+    for col, m in samples.items():
+        m[~np.isfinite(m)] = np.nan
+        lo, hi = np.nanpercentile(m, q, axis=0)
+        cis[col] = (lo, hi)
+
+    return cis
+
+
 def calc_metrics_arrays(y, yhat, columns):
     "standard metrics for `yhat` array given actual outcome `y` array"
+    # predictions may be stored in a compact dtype, e.g. float32
+    yhat = yhat.astype(np.float64, copy=False)
     metrics = []
     for col in columns:
         if col == 'logloss':
@@ -150,42 +267,305 @@ def calc_metrics_arrays(y, yhat, columns):
     return metrics
 
 
-def concordance(data, prediction):
-    "Concordance; less than 0.12 is passing; data should be the full dataset."
+def fraction_bested(a, lower_is_better=True):
+    """
+    Fraction of the other columns bested by each element of each row of `a`.
+
+    `a` is a 2d array, e.g. eras as rows and names as columns. Element
+    (i, j) of the output is the fraction of the other columns in row i
+    whose value is strictly worse than a[i, j]. Ties are not counted as
+    bested and comparisons with NaN are false.
+
+    Each row is ranked with a single argsort along the columns so the cost
+    is O(nrows x ncols log ncols).
+    """
+    a = np.asarray(a, dtype=np.float64)
+    nrow, ncol = a.shape
+    if lower_is_better:
+        # bested means smaller, so flip sign; NaNs still sort last
+        a = -a
+    rows = np.arange(nrow).reshape(-1, 1)
+    order = np.argsort(a, axis=1, kind='mergesort')
+    s = a[rows, order]
+
+    # position of first element in each group of tied values
+    pos = np.arange(ncol).reshape(1, -1)
+    start = np.ones(s.shape, dtype=bool)
+    start[:, 1:] = s[:, 1:] != s[:, :-1]
+    first = np.where(start, pos, 0)
+    first = np.maximum.accumulate(first, axis=1)
+
+    # number of elements in row that are strictly smaller; NaNs sort last
+    nless = np.where(np.isfinite(s), first, 0)
+
+    bested = np.empty(s.shape)
+    bested[rows, order] = nless
+    bested /= ncol - 1.0
+
+    return bested
+
+
+def concordance(data, prediction, n_jobs=1):
+    """
+    Concordance; less than 0.12 is passing; data should be the full dataset.
+
+    The clusters fit to `data` are cached (keyed by the data digest) so that
+    repeated calls with the same data do not refit them. Names are scored in
+    parallel in a pool of `n_jobs` threads.
+    """
 
     concords = pd.DataFrame(columns=['concord'], index=prediction.names)
 
+    # fit clusters (or reuse the clusters cached from a previous call)
+    groups, ids = concordance_clusters(data)
+
+    # yhats for each region; align prediction rows with data rows once
+    yhats = []
+    for region_ids in ids:
+        yhats.append(_align_rows(prediction, region_ids))
+
+    # cross cluster distance (KS distance)
+    index = np.arange(prediction.shape[1])
+    if n_jobs > 1 and index.size > 1:
+        chunks = np.array_split(index, min(n_jobs, index.size))
+        pool = ThreadPool(len(chunks))
+        try:
+            concord = pool.map(lambda c: _concordance(yhats, groups, c),
+                               chunks)
+        finally:
+            pool.close()
+        concord = np.concatenate(concord)
+    else:
+        concord = _concordance(yhats, groups, index)
+    concords['concord'] = concord
+
+    concords = concords.sort_values('concord')
+
+    return concords
+
+
+def concordance_clusters(data):
+    """
+    Row index of each cluster in each tournament region plus region ids.
+
+    The clusters are fit once per dataset; results are cached by the md5
+    digest of the data's content (see ``Data.digest``).
+    """
+    key = data.digest()
+    if key in CONCORDANCE_CACHE:
+        return CONCORDANCE_CACHE[key]
+
     # fit clusters
     kmeans = MiniBatchKMeans(n_clusters=5, random_state=1337)
     kmeans.fit(data.x)
 
-    # yhats and clusters for each region
-    yhats = []
+    # row index of each cluster for each region
     clusters = []
+    ids = []
     for region in ['validation', 'test', 'live']:
         d = data[region]
-        cluster = kmeans.predict(d.x)
-        clusters.append(cluster)
-        yh = prediction.df.loc[d.df.index].values  # align
-        yhats.append(yh)
+        clusters.append(kmeans.predict(d.x))
+        ids.append(d.df.index)
+    groups = []
+    for cluster in clusters:
+        g = [np.flatnonzero(cluster == j) for j in set(clusters[0])]
+        groups.append(g)
+
+    if len(CONCORDANCE_CACHE) >= CONCORDANCE_CACHE_SIZE:
+        CONCORDANCE_CACHE.clear()
+    CONCORDANCE_CACHE[key] = (groups, ids)
+
+    return groups, ids
+
+
+def _align_rows(prediction, ids):
+    "2d array of prediction.y for rows `ids`; NaN where id is missing"
+    idx = prediction.df.index.get_indexer(ids)
+    yhat = prediction.y[idx]
+    missing = idx == -1
+    if missing.any():
+        yhat[missing] = np.nan
+    return yhat
+
+
+def _concordance(yhats, groups, index):
+    "Concordance of prediction columns `index` given aligned yhats and groups"
+    ks = np.zeros((len(groups[0]), index.size))
+    for j in range(len(groups[0])):
+        # sort each column once per region and cluster
+        y0 = np.sort(yhats[0][groups[0][j]][:, index], axis=0)
+        y1 = np.sort(yhats[1][groups[1][j]][:, index], axis=0)
+        y2 = np.sort(yhats[2][groups[2][j]][:, index], axis=0)
+        for i in range(index.size):
+            d = [_ks_2samp_sorted(y0[:, i], y1[:, i]),
+                 _ks_2samp_sorted(y0[:, i], y2[:, i]),
+                 _ks_2samp_sorted(y2[:, i], y1[:, i])]
+            ks[j, i] = max(d)
+    return ks.mean(axis=0)
+
+
+def pearsonr_matrix(y1, y2):
+    """
+    Pearson correlation of each column of `y1` with each column of `y2`.
 
-    # cross cluster distance (KS distance)
-    for i, name in enumerate(prediction.names):
-        ks = []
-        for j in set(clusters[0]):
-            yhat0 = yhats[0][:, i][clusters[0] == j]
-            yhat1 = yhats[1][:, i][clusters[1] == j]
-            yhat2 = yhats[2][:, i][clusters[2] == j]
-            d = [ks_2samp(yhat0, yhat1),
-                 ks_2samp(yhat0, yhat2),
-                 ks_2samp(yhat2, yhat1)]
-            ks.append(max(d))
-        concord = np.mean(ks)
-        concords.loc[name] = concord
+    Each column is standardized once and the full correlation matrix, with
+    shape (y1.shape[1], y2.shape[1]), is computed with a single matmul.
+    """
+    z1 = _standardize(y1)
+    z2 = _standardize(y2)
+    corr = np.dot(z1.T, z2)
+    corr = np.clip(corr, -1.0, 1.0)
+    return corr
 
-    concords = concords.sort_values('concord')
 
-    return concords
+def _standardize(y):
+    "Columns of 2d `y` scaled so that z[:, i].dot(z[:, j]) is a correlation"
+    y = np.asarray(y, dtype=np.float64)
+    z = y - y.mean(axis=0)
+    z /= np.sqrt((z * z).sum(axis=0))
+    return z
+
+
+def correlation_matrix(y, era=None, chunksize=100000, dtype=np.float32):
+    """
+    Correlation matrix of the columns of the 2d array `y`.
+
+    Rows that contain a missing value are skipped. The matrix is accumulated
+    over chunks of `chunksize` rows in `dtype` precision to bound memory. If
+    `era` (one value per row of `y`) is given then the correlation is
+    calculated within each era and then averaged across eras.
+    """
+    if era is not None:
+        era = np.asarray(era)
+        eras = np.unique(era[np.isfinite(era)])
+        corrs = []
+        for e in eras:
+            idx = era == e
+            if idx.sum() > 1:
+                corrs.append(correlation_matrix(y[idx], chunksize=chunksize,
+                                                dtype=dtype))
+        if len(corrs) == 0:
+            return np.nan * np.ones((y.shape[1], y.shape[1]))
+        return np.nanmean(corrs, axis=0)
+
+    # first pass: mean of rows without missing values
+    n = 0
+    total = np.zeros(y.shape[1])
+    for i in range(0, y.shape[0], chunksize):
+        z = y[i:i + chunksize]
+        z = z[np.isfinite(z.sum(axis=1))]
+        n += z.shape[0]
+        total += z.sum(axis=0)
+    mean = total / n
+
+    # second pass: covariance of the demeaned chunks
+    cov = np.zeros((y.shape[1], y.shape[1]))
+    for i in range(0, y.shape[0], chunksize):
+        z = y[i:i + chunksize]
+        z = z[np.isfinite(z.sum(axis=1))]
+        z = (z - mean).astype(dtype)
+        cov += np.dot(z.T, z)
+    std = np.sqrt(np.diag(cov))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = cov / np.outer(std, std)
+    corr = np.clip(corr, -1.0, 1.0)
+
+    return corr
+
+
+def correlation_matrix_chunked(y, colchunk, rows=None, era=None,
+                               dtype=np.float32):
+    """
+    Correlation of columns of 2d `y`, reading `colchunk` columns at a time.
+
+    Use this instead of ``correlation_matrix`` when `y` has too many columns
+    to fit in memory (e.g. `y` is memory mapped): at most two chunks of
+    columns are in memory at once. The output has shape (len(rows),
+    y.shape[1]) where `rows` is an array of column indices; by default
+    (None) all columns and the output is the full correlation matrix. Rows
+    of `y` with a missing value are skipped. If `era` is given then the
+    correlation is calculated within each era and averaged across eras.
+    """
+    nrows, ncols = y.shape
+    chunks = [slice(i, min(i + colchunk, ncols))
+              for i in range(0, ncols, colchunk)]
+
+    # rows of y without missing values, grouped by era
+    keep = np.ones(nrows, dtype=bool)
+    for c in chunks:
+        keep &= np.isfinite(y[:, c]).all(axis=1)
+    if era is None:
+        groups = [np.flatnonzero(keep)]
+    else:
+        era = np.asarray(era)
+        keep &= np.isfinite(era)
+        groups = [np.flatnonzero(keep & (era == e))
+                  for e in np.unique(era[keep])]
+    groups = [g for g in groups if g.size > 1]
+
+    def standardize(idx):
+        "Standardized columns `idx` of y for each era"
+        yc = y[:, idx]
+        return [_standardize(yc[g]).astype(dtype) for g in groups]
+
+    # blocks of output rows and the columns of y they correspond to
+    symmetric = rows is None
+    if symmetric:
+        rows = np.arange(ncols)
+    rows = np.asarray(rows)
+    blocks = [slice(i, min(i + colchunk, rows.size))
+              for i in range(0, rows.size, colchunk)]
+
+    total = np.zeros((rows.size, ncols))
+    count = np.zeros((rows.size, ncols))
+    for i, r in enumerate(blocks):
+        zr = standardize(rows[r])
+        for j, c in enumerate(chunks):
+            if symmetric and j < i:
+                # filled in from the transpose of an earlier block
+                continue
+            zc = zr if symmetric and j == i else standardize(c)
+            for a, b in zip(zr, zc):
+                corr = np.dot(a.T, b)
+                finite = np.isfinite(corr)
+                total[r, c] += np.where(finite, corr, 0)
+                count[r, c] += finite
+            if symmetric and j > i:
+                total[c, r] = total[r, c].T
+                count[c, r] = count[r, c].T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = total / count
+    corr = np.clip(corr, -1.0, 1.0)
+
+    return corr
+
+
+def ks_2samp_matrix(y1, y2, n_jobs=1):
+    """
+    KS statistic of each column of `y1` with each column of `y2`.
+
+    Each column is sorted once; the pairwise statistics are computed from
+    the presorted columns, optionally in a pool of `n_jobs` threads. The
+    output has shape (y1.shape[1], y2.shape[1]).
+    """
+    s1 = np.sort(y1, axis=0)
+    s2 = np.sort(y2, axis=0)
+    s1 = [s1[:, i].copy() for i in range(s1.shape[1])]
+    s2 = [s2[:, i].copy() for i in range(s2.shape[1])]
+
+    def ks_row(a):
+        return [_ks_2samp_sorted(a, b) for b in s2]
+
+    if n_jobs > 1 and len(s1) > 1:
+        pool = ThreadPool(min(n_jobs, len(s1)))
+        try:
+            ks = pool.map(ks_row, s1)
+        finally:
+            pool.close()
+    else:
+        ks = [ks_row(a) for a in s1]
+    ks = np.array(ks, dtype=np.float64).reshape(len(s1), len(s2))
+    return ks
 
 
 # copied from scipy to avoid scipy dependency; modified for use in numerox
@@ -222,6 +602,11 @@ def ks_2samp(y1, y2):
     """
     y1 = np.sort(y1)
     y2 = np.sort(y2)
+    return _ks_2samp_sorted(y1, y2)
+
+
+def _ks_2samp_sorted(y1, y2):
+    "Kolmogorov-Smirnov statistic of two presorted 1d arrays"
     n1 = y1.shape[0]
     n2 = y2.shape[0]
     data_all = np.concatenate([y1, y2])
@@ -1,23 +1,51 @@
 import sys
 import os
+import glob
+import gzip
+import io
+import time
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 import numpy as np
 
-import numerox as nx
 from numerox.metrics import metrics_per_era
 from numerox.metrics import metrics_per_name
-from numerox.metrics import pearsonr
-from numerox.metrics import ks_2samp
+from numerox.metrics import logloss_per_era
+from numerox.metrics import pearsonr_matrix
+from numerox.metrics import ks_2samp_matrix
+from numerox.metrics import correlation_matrix
+from numerox.metrics import correlation_matrix_chunked
+from numerox.metrics import fraction_bested
 from numerox.metrics import concordance
 from numerox.metrics import LOGLOSS_BENCHMARK
+from numerox.data import TOURNAMENT_REGIONS
 
 if sys.version_info[0] == 2:
     BASE_STRING = basestring
 else:
     BASE_STRING = str  # pragma: no cover
 
+try:
+    # the pyarrow csv parser (pandas >= 1.4) is multithreaded
+    import pyarrow  # noqa
+    _pandas_version = tuple(int(v) for v in pd.__version__.split('.')[:2])
+    CSV_ENGINE = 'pyarrow' if _pandas_version >= (1, 4) else 'c'
+except ImportError:
+    CSV_ENGINE = 'c'
+
 HDF_PREDICTION_KEY = 'numerox_prediction'
+HDF_IDS_KEY = 'numerox_prediction_ids'
+HDF_NAMES_KEY = 'numerox_prediction_names'
+HDF_Y_KEY = 'numerox_prediction_y'
+
+MMAP_IDS_FILE = 'ids.npy'
+MMAP_NAMES_FILE = 'names.npy'
+MMAP_Y_FILE = 'y.npy'
+
+# names are streamed through performance, dominance, correlation and
+# originality in chunks of at most this many bytes (as float64)
+CHUNK_NBYTES = 2 ** 28
 
 ORIGINALITY_CORR_LTE = 0.95
 ORIGINALITY_KS_GT = 0.03
@@ -27,7 +55,25 @@ CONCORDANCE_LT = 0.12
 
 class Prediction(object):
 
-    def __init__(self, df=None):
+    # True if made by a run that stopped before predicting all of its folds
+    partial = False
+
+    def __init__(self, df=None, dtype=None):
+        """
+        Prediction object.
+
+        Parameters
+        ----------
+        df : {pandas.DataFrame, None}, optional
+            DataFrame with row ids as index and model names as columns. By
+            default (None) the prediction is empty.
+        dtype : {numpy dtype, None}, optional
+            Storage dtype of the predictions, e.g. np.float32 to halve
+            memory use. Metrics are always calculated in float64. By default
+            (None) the dtype of `df` is used.
+        """
+        if df is not None and dtype is not None:
+            df = df.astype(dtype, copy=False)
         self.df = df
 
     @property
@@ -95,10 +141,27 @@ class Prediction(object):
                           columns=self.df.columns.copy())
         return Prediction(df)
 
-    def iter(self):
-        "Yield a prediction object with only one model at a time"
-        for name in self.names:
-            yield self[name]
+    def column(self, name):
+        "View of the predictions of model `name` as a 1d numpy float array"
+        if self.df is None:
+            raise ValueError("prediction is empty")
+        return self.y[:, self.df.columns.get_loc(name)]
+
+    def iter(self, copy=True):
+        """
+        Yield a prediction object with only one model at a time.
+
+        If `copy` is False then each prediction object yielded is a view
+        that shares memory with the parent prediction, which saves copying
+        the data of every name in loops over names. Don't modify the view
+        unless you intend to modify the parent.
+        """
+        if copy:
+            for name in self.names:
+                yield self[name]
+        else:
+            for j in range(self.shape[1]):
+                yield Prediction(self.df.iloc[:, j:j + 1])
 
     def merge_arrays(self, ids, y, name):
         "Merge numpy arrays `ids` and `y` with name `name`"
@@ -106,16 +169,22 @@ class Prediction(object):
         prediction = Prediction(df)
         return self.merge(prediction)
 
-    def merge(self, prediction):
-        "Merge prediction"
-        return merge_predictions([self, prediction])
+    def merge(self, prediction, dtype=None):
+        "Merge prediction; optionally specify dtype of merged prediction"
+        return merge_predictions([self, prediction], dtype=dtype)
 
-    def save(self, path_or_buf, compress=True, mode='w'):
+    def save(self, path_or_buf, compress=True, mode='w', dtype=None,
+             replace=False):
         """
         Save prediction as an hdf archive.
 
         Raises a ValueError if the prediction is empty.
 
+        Each name is stored as its own dataset against a shared table of
+        ids. So appending, replacing, or adding rows to a name only writes
+        that name's column; the other names in the archive are not read or
+        rewritten.
+
         Parameters
         ----------
         path_or_buf : {str, HDFStore}
@@ -124,10 +193,21 @@ class Prediction(object):
             Whether or not to compress the archive. The default (True) is to
             compress.
         mode : str, optional
-            The save mode. By default ('w') the archive is overwritten if it
-            exists and created if not. With mode 'a' the prediction is
-            appended to the archive (the archive must already exist and it
-            must contain a prediction object).
+            The save mode. By default ('w') any prediction in the archive is
+            overwritten; other keys in the hdf file are kept and the file is
+            created if it does not exist. With mode 'a' the prediction is
+            appended to the archive. Appending a name that is already in the
+            archive adds its rows; as with `merge`, a ValueError is raised
+            if the same name and id are in both.
+        dtype : {numpy dtype, None}, optional
+            The dtype of the saved predictions. For example, use np.float16
+            to make a compact archive. By default (None) the dtype of the
+            prediction is used. Names already in the archive keep their dtype
+            unless they are replaced.
+        replace : bool, optional
+            Only used with mode 'a'. If True then names of the prediction
+            that are already in the archive are replaced (their rows in the
+            archive are dropped) instead of added to. Default is False.
 
         Returns
         -------
@@ -137,26 +217,152 @@ class Prediction(object):
             raise ValueError("Prediction object is empty; nothing to save")
         if mode not in ('w', 'a'):
             raise ValueError("`mode` must be 'w' or 'a'")
-        if mode == 'a':
-            p = nx.load_prediction(path_or_buf)
-            self = p.merge(self)
-        if compress:
-            self.df.to_hdf(path_or_buf, HDF_PREDICTION_KEY,
-                           complib='zlib', complevel=4)
+        if dtype is not None:
+            self = Prediction(self.df, dtype=dtype)
+        # the file is opened with mode 'a' even when overwriting: the file
+        # may hold other keys and _write_hdf removes only the prediction's
+        store, close = _hdf_store(path_or_buf, 'a', compress)
+        try:
+            if mode == 'a' and HDF_PREDICTION_KEY in store:
+                # archive from older version of numerox; convert it
+                df = store.get(HDF_PREDICTION_KEY)
+                store.remove(HDF_PREDICTION_KEY)
+                if replace:
+                    df = df.drop(columns=[n for n in self.names if n in df])
+                if df.shape[1] > 0:
+                    self = Prediction(df).merge(self, dtype=dtype)
+            if mode == 'a' and HDF_IDS_KEY in store:
+                _append_hdf(store, self, replace)
+            else:
+                _write_hdf(store, self)
+        finally:
+            if close:
+                store.close()
+
+    def save_mmap(self, dirname, mode='w', dtype=None):
+        """
+        Save prediction as a directory of memory-mappable numpy files.
+
+        The predictions are stored in a single column-major (Fortran order)
+        npy file so that each chunk of names is contiguous on disk. Load with
+        ``load_prediction_mmap``, which memory maps the file instead of
+        reading it into memory, for collections of names too large for RAM.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory in which to save the prediction. It is created if it
+            does not exist.
+        mode : str, optional
+            The save mode. By default ('w') any prediction saved in
+            `dirname` is overwritten. With mode 'a' the names of the
+            prediction are appended to those already saved; the new names
+            are written to the end of the file without rewriting the saved
+            names. When appending, the names must not already be saved and
+            the ids must be a subset of the saved ids (missing ids are
+            saved as NaN).
+        dtype : {numpy dtype, None}, optional
+            The dtype of the saved predictions. By default (None) the dtype
+            of the prediction is used. Ignored when appending to an existing
+            file, which keeps its dtype.
+
+        Returns
+        -------
+        None
+        """
+        if self.df is None:
+            raise ValueError("Prediction object is empty; nothing to save")
+        if mode not in ('w', 'a'):
+            raise ValueError("`mode` must be 'w' or 'a'")
+        if mode == 'a' and os.path.exists(os.path.join(dirname, MMAP_Y_FILE)):
+            _append_mmap(dirname, self)
         else:
-            self.df.to_hdf(path_or_buf, HDF_PREDICTION_KEY)
+            _write_mmap(dirname, self, dtype)
+
+    def to_csv(self, path_or_buf=None, decimals=6, verbose=False,
+               compress=False):
+        """
+        Save a csv file of predictions; prediction must contain only one name.
+
+        Parameters
+        ----------
+        path_or_buf : {str, file-like, None}, optional
+            File path or open (text) buffer. If None (default) then the csv
+            text is returned as a string.
+        decimals : int, optional
+            Number of decimal places written. Default is 6.
+        verbose : bool, optional
+            Whether to print the name of the file saved. Default is False.
+        compress : bool, optional
+            If True then the file written to `path_or_buf` (which must be a
+            file path) is gzip compressed. Default is False.
 
-    def to_csv(self, path_or_buf=None, decimals=6, verbose=False):
-        "Save a csv file of predictions; predictin must contain only one name"
+        Returns
+        -------
+        text : {str, None}
+            The csv text if `path_or_buf` is None; otherwise None.
+        """
         if self.shape[1] != 1:
             raise ValueError("prediction must contain a single name")
-        df = self.df.iloc[:, 0].to_frame('probability')
-        df.index.rename('id', inplace=True)
-        float_format = "%.{}f".format(decimals)
-        df.to_csv(path_or_buf, float_format=float_format)
+        data = _csv_bytes(self.df.index.values, self.y[:, 0], decimals)
+        if path_or_buf is None:
+            return data.decode('utf-8')
+        _write_bytes(path_or_buf, data, compress)
         if verbose:
             print("Save {}".format(path_or_buf))
 
+    def to_csv_dir(self, dir_path, decimals=6, compress=False, n_jobs=1,
+                   verbose=False):
+        """
+        Save one csv submission file per name in a directory.
+
+        Each name is saved to `dir_path/name.csv` (or `name.csv.gz` if
+        `compress` is True). The directory is created if it does not exist.
+
+        Parameters
+        ----------
+        dir_path : str
+            Directory in which to save the csv files.
+        decimals : int, optional
+            Number of decimal places written. Default is 6.
+        compress : bool, optional
+            Whether to gzip compress the csv files. Default is False.
+        n_jobs : int, optional
+            Number of files to format and write concurrently (threads).
+            Default is 1.
+        verbose : bool, optional
+            Whether to print the name of each file saved. Default is False.
+
+        Returns
+        -------
+        paths : list
+            List of file paths saved, in the order of `names`.
+        """
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        ext = '.csv.gz' if compress else '.csv'
+        ids = self.df.index.values
+        y = self.y
+        names = self.names
+        paths = [os.path.join(dir_path, str(name) + ext) for name in names]
+
+        def write(j):
+            data = _csv_bytes(ids, y[:, j], decimals)
+            _write_bytes(paths[j], data, compress)
+            if verbose:
+                print("Save {}".format(paths[j]))
+
+        if n_jobs == 1 or len(names) < 2:
+            for j in range(len(names)):
+                write(j)
+        else:
+            pool = ThreadPool(min(n_jobs, len(names)))
+            try:
+                pool.map(write, range(len(names)))
+            finally:
+                pool.close()
+        return paths
+
     def summary(self, data, round_output=True):
         "Performance summary of prediction object that contains a single name"
 
@@ -205,12 +411,17 @@ class Prediction(object):
 
     def performance(self, data, era_as_str=True, region_as_str=True,
                     columns=['logloss', 'auc', 'acc', 'ystd', 'sharpe',
-                             'consis'], sort_by='logloss'):
-        df, info = metrics_per_name(data,
-                                    self,
-                                    columns=columns,
-                                    era_as_str=era_as_str,
-                                    region_as_str=region_as_str)
+                             'consis'], sort_by='logloss', bootstrap=None):
+        dfs = []
+        for p in self._iter_chunks(dropna=True):
+            df, info = metrics_per_name(data,
+                                        p,
+                                        columns=columns,
+                                        era_as_str=era_as_str,
+                                        region_as_str=region_as_str,
+                                        bootstrap=bootstrap)
+            dfs.append(df)
+        df = dfs[0] if len(dfs) == 1 else pd.concat(dfs)
         if sort_by in columns:
             if sort_by == 'logloss':
                 df = df.sort_values(by='logloss', ascending=True)
@@ -232,54 +443,97 @@ class Prediction(object):
     def dominance(self, data, sort_by='logloss'):
         "Mean (across eras) of fraction of models bested per era"
         columns = ['logloss', 'auc', 'acc']
-        mpe, regions = metrics_per_era(data, self, columns=columns)
+        pivots = dict((col, []) for col in columns)
+        for p in self._iter_chunks(dropna=True):
+            mpe, regions = metrics_per_era(data, p, columns=columns)
+            for col in columns:
+                pivot = mpe.pivot(index='era', columns='name', values=col)
+                pivots[col].append(pivot)
         dfs = []
-        for i, col in enumerate(columns):
-            pivot = mpe.pivot(index='era', columns='name', values=col)
+        for col in columns:
+            pivot = pd.concat(pivots[col], axis=1)
             names = pivot.columns.tolist()
-            a = pivot.values
-            n = a.shape[1] - 1.0
-            if n == 0:
+            if len(names) < 2:
                 raise ValueError("Must have at least two names")
-            m = []
-            for j in range(pivot.shape[1]):
-                if col == 'logloss':
-                    z = (a[:, j].reshape(-1, 1) < a).sum(axis=1) / n
-                else:
-                    z = (a[:, j].reshape(-1, 1) > a).sum(axis=1) / n
-                m.append(z.mean())
+            z = fraction_bested(pivot.values, col == 'logloss')
+            m = z.mean(axis=0)
             df = pd.DataFrame(data=m, index=names, columns=[col])
             dfs.append(df)
         df = pd.concat(dfs, axis=1)
         df = df.sort_values([sort_by], ascending=[False])
         return df
 
-    def concordance(self, data):
+    def concordance(self, data, n_jobs=1):
         "Less than 0.12 is passing; data should be the full dataset."
-        return concordance(data, self)
+        return concordance(data, self, n_jobs=n_jobs)
+
+    def correlation(self, name=None, data=None, chunksize=100000):
+        """
+        Correlation of predictions.
+
+        Parameters
+        ----------
+        name : {str, None}, optional
+            By default (None) the names x names correlation matrix is
+            returned. If a name is given then the correlation of that name
+            with each of the other names (sorted in descending order) is
+            returned.
+        data : {Data, None}, optional
+            By default (None) the correlation is calculated across all rows.
+            If `data` is given then the correlation is calculated within each
+            era of `data` and then averaged across eras. Rows not in `data`
+            are skipped.
+        chunksize : int, optional
+            The correlation is accumulated over chunks of this many rows in
+            float32 to bound memory when there are many names.
 
-    def correlation(self, name=None):
-        "Correlation of predictions; by default reports given for each model"
-        if name is None:
-            names = self.names
+        Returns
+        -------
+        df : pandas.DataFrame
+            Correlation of predictions.
+        """
+        era = None
+        if data is not None:
+            era = data.df['era'].reindex(self.df.index).values
+        names = self.names
+        colchunk = self._chunksize()
+        if colchunk >= len(names):
+            corr = correlation_matrix(self.df.values, era=era,
+                                      chunksize=chunksize)
+        elif name is None:
+            corr = correlation_matrix_chunked(self.df.values, colchunk,
+                                              era=era)
         else:
-            names = [name]
-        z = self.df.values
-        znames = self.names
-        idx = np.isfinite(z.sum(axis=1))
-        z = z[idx]
-        z = (z - z.mean(axis=0)) / z.std(axis=0)
-        for name in names:
-            print(name)
-            idx = znames.index(name)
-            corr = np.dot(z[:, idx], z) / z.shape[0]
-            index = (-corr).argsort()
-            for ix in index:
-                zname = znames[ix]
-                if name != zname:
-                    print("   {:.4f} {}".format(corr[ix], zname))
-
-    def originality(self, submitted_names):
+            # too many names to hold in memory; correlate one name only
+            j = self.df.columns.get_loc(name)
+            corr = correlation_matrix_chunked(self.df.values, colchunk,
+                                              rows=[j], era=era)
+            df = pd.DataFrame(corr.T, index=names, columns=[name])
+            df = df.drop(name)
+            return df.sort_values(name, ascending=False)
+        df = pd.DataFrame(corr, index=names, columns=names)
+        if name is not None:
+            df = df[[name]].drop(name)
+            df = df.sort_values(name, ascending=False)
+        return df
+
+    def top_correlation(self, k=1, data=None, chunksize=100000):
+        "The `k` names most correlated with each name (and their correlation)"
+        corr = self.correlation(data=data, chunksize=chunksize)
+        names = corr.columns.values
+        c = corr.values.copy()
+        np.fill_diagonal(c, -np.inf)
+        c[np.isnan(c)] = -np.inf
+        k = min(k, len(names) - 1)
+        idx = np.argsort(-c, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(len(names))
+        df = pd.DataFrame(index=names)
+        for i in range(k):
+            df['name' + str(i + 1)] = names[idx[:, i]]
+            df['corr' + str(i + 1)] = corr.values[rows, idx[:, i]]
+        return df
+
+    def originality(self, submitted_names, n_jobs=1):
         "Which models are original given the models already submitted?"
 
         # predictions of models already submitted
@@ -289,48 +543,92 @@ class Prediction(object):
         names = self.names
         names = [m for m in names if m not in submitted_names]
 
-        # originality
-        columns = ['corr', 'corrTF', 'ks', 'ksTF', 'original']
-        df = pd.DataFrame(index=names, columns=columns)
-        for name in names:
-            corr = -np.inf
-            ks = np.inf
-            corrTF = True
-            ksTF = True
-            y = self.df[name].values
-            for i in range(ys.shape[1]):
-                c = np.abs(pearsonr(y, ys[:, i]))
-                if c > corr:
-                    corr = c
-                if corrTF and c > ORIGINALITY_CORR_LTE:
-                    corrTF = False
-                k = ks_2samp(y, ys[:, i])
-                if k < ks:
-                    ks = k
-                if ksTF and k <= ORIGINALITY_KS_GT:
-                    ksTF = False
-            df.loc[name, 'corr'] = corr
-            df.loc[name, 'ks'] = ks
-            df.loc[name, 'corrTF'] = corrTF
-            df.loc[name, 'ksTF'] = ksTF
-            df.loc[name, 'original'] = corrTF and ksTF
+        # pairwise statistics (rows are names, columns are submitted names)
+        colchunk = self._chunksize()
+        corr = [np.empty((0, ys.shape[1]))]
+        ks = [np.empty((0, ys.shape[1]))]
+        for i in range(0, len(names), colchunk):
+            y = self.df[names[i:i + colchunk]].values
+            corr.append(np.abs(pearsonr_matrix(y, ys)))
+            ks.append(ks_2samp_matrix(y, ys, n_jobs=n_jobs))
+        corr = np.concatenate(corr)
+        ks = np.concatenate(ks)
+
+        # originality; with no submitted names every name is original
+        df = pd.DataFrame(index=names)
+        df['corr'] = corr.max(axis=1, initial=-np.inf)
+        df['corrTF'] = (corr <= ORIGINALITY_CORR_LTE).all(axis=1)
+        df['ks'] = ks.min(axis=1, initial=np.inf)
+        df['ksTF'] = (ks > ORIGINALITY_KS_GT).all(axis=1)
+        df['original'] = df['corrTF'] & df['ksTF']
 
         return df
 
-    def check(self, submitted_names, data):
-        "Run all Numerai checks against the already submitted names list"
+    def check(self, submitted_names, data, n_jobs=3, timing=False):
+        """
+        Run all Numerai checks against the already submitted names list.
+
+        Parameters
+        ----------
+        submitted_names : list
+            Names in the prediction object that have already been submitted.
+            Originality is measured against these names.
+        data : Data
+            The full dataset (concordance fits its clusters to all of it).
+        n_jobs : int, optional
+            The originality, concordance, and performance reports are
+            independent; by default (3) they are run concurrently in a pool
+            of threads. Concordance also scores names in a pool of `n_jobs`
+            threads. Use 1 to run everything one after the other.
+        timing : bool, optional
+            If True then also return the wall-clock time in seconds of each
+            stage. Default is False.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            Check results of each name that has not yet been submitted.
+        timings : pandas.Series
+            Seconds taken by each stage. Only returned if `timing` is True.
+        """
+
+        timings = pd.Series(dtype=np.float64, name='seconds')
+        t0 = time.time()
 
-        # concordance only defined for tournament predictions
-        ids = data['tournament'].ids
-        pred = self.loc[ids]
+        # region subsets are views of data; concordance is only defined
+        # for tournament predictions
+        tourn = data._region_view(TOURNAMENT_REGIONS)
+        valid = data._region_view(['validation'])
+        pred = self.loc[tourn.df.index]
+        timings['subset'] = time.time() - t0
 
         # run reports
-        df1 = pred.originality(submitted_names)[['corr', 'ks']]
-        df2 = pred.concordance(data)
-        df3 = pred.performance(data['validation'], columns=['consis'])
+        stages = [
+            ('originality',
+             lambda: pred.originality(submitted_names)[['corr', 'ks']]),
+            ('concordance', lambda: pred.concordance(data, n_jobs=n_jobs)),
+            ('performance',
+             lambda: pred.performance(valid, columns=['consis']))]
+
+        def run_stage(stage):
+            t = time.time()
+            df = stage[1]()
+            return df, time.time() - t
+
+        if n_jobs > 1:
+            pool = ThreadPool(min(n_jobs, len(stages)))
+            try:
+                reports = pool.map(run_stage, stages)
+            finally:
+                pool.close()
+        else:
+            reports = [run_stage(stage) for stage in stages]
+        for stage, report in zip(stages, reports):
+            timings[stage[0]] = report[1]
 
         # concatenate reports
-        df = pd.concat([df1, df2, df3], axis=1)
+        t = time.time()
+        df = pd.concat([report[0] for report in reports], axis=1)
         df = df.drop(submitted_names)
 
         # add True/False columns (i.e. Pass/Fail)
@@ -339,53 +637,80 @@ class Prediction(object):
         df['concordTF'] = df['concord'] < CONCORDANCE_LT
         df['consisTF'] = df['consis'] >= CONSISTENCY_GTE
         df['pass'] = df.all(axis=1)
+        timings['report'] = time.time() - t
+        timings['total'] = time.time() - t0
 
+        if timing:
+            return df, timings
         return df
 
     def compare(self, data, prediction):
         "Compare performance of predictions with the same names"
         cols = ['logloss1', 'logloss2', 'win1',
                 'corr', 'maxdiff', 'ystd1', 'ystd2']
-        comp = pd.DataFrame(columns=cols)
-        names = []
-        for name in self.names:
-            if name in prediction:
-                names.append(name)
+        names = [name for name in self.names if name in prediction]
         if len(names) == 0:
-            return comp
-        ids = data.ids
-        df1 = self.loc[ids]
-        df2 = prediction.loc[ids]
+            return pd.DataFrame(columns=cols)
         p1 = self[names]
         p2 = prediction[names]
-        m1 = p1.metrics_per_era(data, metrics=['logloss', 'auc', 'ystd'],
-                                era_as_str=False)
-        m2 = p2.metrics_per_era(data, metrics=['logloss', 'auc', 'ystd'],
-                                era_as_str=False)
-        for name in names:
-
-            m1i = m1[m1.name == name]
-            m2i = m2[m2.name == name]
 
-            if (m1i.index != m2i.index).any():
-                raise IndexError("Can only handle aligned eras")
-
-            logloss1 = m1i.logloss.mean()
-            logloss2 = m2i.logloss.mean()
-            win1 = (m1i.logloss < m2i.logloss).mean()
+        # per-era logloss of all names of both predictions in one pass
+        both = Prediction(pd.concat([p1.df, p2.df], axis=1))
+        m = logloss_per_era(data, both)
+        m1 = m.iloc[:, :len(names)]
+        m2 = m.iloc[:, len(names):]
+        logloss1 = m1.mean().values
+        logloss2 = m2.mean().values
+        with np.errstate(invalid='ignore'):
+            win1 = (m1.values < m2.values).mean(axis=0)
+
+        # column-wise comparison of all names
+        ids = data.ids
+        y1 = p1.loc[ids].y.astype(np.float64)
+        y2 = p2.loc[ids].y.astype(np.float64)
+        ystd1 = y1.std(axis=0)
+        ystd2 = y2.std(axis=0)
+        d1 = y1 - y1.mean(axis=0)
+        d2 = y2 - y2.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = (d1 * d2).mean(axis=0) / (ystd1 * ystd2)
+        maxdiff = np.abs(y1 - y2).max(axis=0)
+
+        m = [logloss1, logloss2, win1, corr, maxdiff, ystd1, ystd2]
+        comp = pd.DataFrame(dict(zip(cols, m)), index=names, columns=cols)
 
-            y1 = df1[name].y.reshape(-1)
-            y2 = df2[name].y.reshape(-1)
+        return comp
 
-            corr = np.corrcoef(y1, y2)[0, 1]
-            maxdiff = np.abs(y1 - y2).max()
-            ystd1 = y1.std()
-            ystd2 = y2.std()
+    def _chunksize(self):
+        "Number of names per chunk when streaming over names"
+        nbytes = 8 * max(1, self.shape[0])
+        return max(1, CHUNK_NBYTES // nbytes)
 
-            m = [logloss1, logloss2, win1, corr, maxdiff, ystd1, ystd2]
-            comp.loc[name] = m
+    def _iter_chunks(self, dropna=False):
+        """
+        Yield views of the prediction that each contain a chunk of names.
 
-        return comp
+        If `dropna` is True then rows that are NaN in any name of the whole
+        prediction are dropped from every chunk (the chunks are then copies)
+        so that metrics, which drop such rows, do not depend on chunking.
+        """
+        colchunk = self._chunksize()
+        if colchunk >= self.shape[1]:
+            yield self
+            return
+        keep = None
+        if dropna:
+            keep = np.ones(self.shape[0], dtype=bool)
+            for i in range(0, self.shape[1], colchunk):
+                y = self.df.iloc[:, i:i + colchunk].values
+                keep &= ~np.isnan(y).any(axis=1)
+            if keep.all():
+                keep = None
+        for i in range(0, self.shape[1], colchunk):
+            df = self.df.iloc[:, i:i + colchunk]
+            if keep is not None:
+                df = df[keep]
+            yield Prediction(df)
 
     def copy(self):
         "Copy of prediction"
@@ -464,6 +789,63 @@ class Prediction(object):
         return fmt.format(shape[0], shape[1], frac_miss)
 
 
+class PredictionBuilder(object):
+    """
+    Accumulate the (ids, y) arrays of a single name into a prediction.
+
+    The arrays are copied into buffers that are preallocated with room for
+    `nrows` rows (the buffers grow if needed) so that adding each fold
+    of a run does not copy all of the earlier folds like merge does.
+    Overlapping ids (with non-missing y) raise a ValueError, as they do in
+    merge, when the prediction is made.
+    """
+
+    def __init__(self, name, nrows=0):
+        self.name = name
+        self.ids = np.empty(nrows, dtype=object)
+        self.yhat = np.empty(nrows)
+        self.nrows = 0
+        self.nappend = 0
+
+    def append(self, ids, y):
+        "Append arrays `ids` and `y` to the buffers"
+        n = self.nrows + len(ids)
+        if n > self.yhat.size:
+            size = max(n, 2 * self.yhat.size)
+            self.ids = np.concatenate((self.ids[:self.nrows],
+                                       np.empty(size - self.nrows, object)))
+            self.yhat = np.concatenate((self.yhat[:self.nrows],
+                                        np.empty(size - self.nrows)))
+        self.ids[self.nrows:n] = ids
+        self.yhat[self.nrows:n] = y
+        self.nrows = n
+        self.nappend += 1
+
+    def prediction(self):
+        "Prediction (a copy) containing all the arrays appended so far"
+        if self.nappend == 0:
+            return Prediction(None)
+        index = pd.Index(self.ids[:self.nrows])
+        y = self.yhat[:self.nrows].copy()
+        if self.nappend > 1:
+            # same as merging: overlap only if both ys are not missing
+            isnan = np.isnan(y)
+            if index[~isnan].has_duplicates:
+                msg = "overlap in predictions of `{}` (same name and id)"
+                raise ValueError(msg.format(self.name))
+            if index.has_duplicates:
+                order = np.argsort(isnan, kind='mergesort')
+                keep = order[~index[order].duplicated()]
+                index = index[keep]
+                y = y[keep]
+            # ids are sorted as they would be by merge
+            order = index.argsort()
+            index = index[order]
+            y = y[order]
+        df = pd.DataFrame(data={self.name: y}, index=index)
+        return Prediction(df)
+
+
 class Loc(object):
     "Utility class for the loc method."
 
@@ -474,62 +856,568 @@ class Loc(object):
         return Prediction(self.prediction.df.loc[index])
 
 
-def load_prediction(filename):
-    "Load prediction object from hdf archive"
-    df = pd.read_hdf(filename, key=HDF_PREDICTION_KEY)
+def load_prediction(filename, names=None, dtype=None):
+    """
+    Load prediction object from hdf archive.
+
+    By default (`names` is None) all names in the archive are loaded.
+    Otherwise only the columns of the given name or list of names are read.
+
+    By default (`dtype` is None) the predictions are loaded with the dtype
+    they were saved with except that float16, which is meant for archiving
+    only, is loaded as float32.
+    """
+    if isinstance(names, BASE_STRING):
+        names = [names]
+    store, close = _hdf_store(filename, 'r')
+    try:
+        if HDF_PREDICTION_KEY in store:
+            # archive from older version of numerox
+            df = store.get(HDF_PREDICTION_KEY)
+            if names is not None:
+                df = df[names]
+            return Prediction(df, dtype=dtype)
+        index = store.get(HDF_IDS_KEY).index
+        stored = store.get(HDF_NAMES_KEY)
+        if names is None:
+            names = stored.index.tolist()
+        for name in names:
+            if name not in stored:
+                raise ValueError("`{}` is not in archive".format(name))
+        if dtype is None:
+            dtypes = [_hdf_column(store, stored[n]).dtype for n in names]
+            dtype = np.result_type(np.float32, *dtypes)
+        y = np.empty((index.size, len(names)), dtype=dtype, order='F')
+        for j, name in enumerate(names):
+            y[:, j] = _read_hdf_column(store, stored[name], index.size)
+    finally:
+        if close:
+            store.close()
+    df = pd.DataFrame(data=y, index=index, columns=names)
     return Prediction(df)
 
 
 def load_prediction_csv(filename, name=None):
     "Load prediction object from a Numerai csv (text) tournament file"
-    df = pd.read_csv(filename, index_col='id')
-    if df.shape[1] != 1:
-        raise ValueError("csv file must contain on column of predictions")
     if name is None:
-        name = os.path.split(filename)[-1]
-        if name.endswith('.csv'):
-            name = name[:-4]
-    df.columns = [name]
+        name = _csv_name(filename)
+    ids, y = _read_prediction_csv(filename)
+    df = pd.DataFrame(data=y, index=ids, columns=[name])
+    return Prediction(df)
+
+
+def load_predictions_csv(paths_or_glob, names=None, dtype=None, n_jobs=1):
+    """
+    Load and merge many Numerai csv (text) tournament files.
+
+    Parameters
+    ----------
+    paths_or_glob : {str, list}
+        A glob pattern such as 'submissions/*.csv' (files are loaded in
+        sorted order) or a list of file paths. Gzip compressed files
+        (.csv.gz) are decompressed.
+    names : list, optional
+        Names of the predictions, one per file. By default (None) each name
+        is the file name without its .csv or .csv.gz extension.
+    dtype : {numpy.dtype, str, None}, optional
+        Storage dtype of the merged prediction. See ``merge_predictions``.
+    n_jobs : int, optional
+        Number of files to parse concurrently (threads). Default is 1.
+
+    Returns
+    -------
+    prediction : Prediction
+        All files merged into a single prediction object.
+    """
+    if isinstance(paths_or_glob, BASE_STRING):
+        paths = sorted(glob.glob(paths_or_glob))
+        if len(paths) == 0:
+            raise IOError("no files match `{}`".format(paths_or_glob))
+    else:
+        paths = list(paths_or_glob)
+    if names is None:
+        names = [_csv_name(path) for path in paths]
+    elif len(names) != len(paths):
+        raise ValueError("`names` must contain one name per file")
+    if n_jobs == 1 or len(paths) < 2:
+        arrays = [_read_prediction_csv(path) for path in paths]
+    else:
+        pool = ThreadPool(min(n_jobs, len(paths)))
+        try:
+            arrays = pool.map(_read_prediction_csv, paths)
+        finally:
+            pool.close()
+    predictions = []
+    for (ids, y), name in zip(arrays, names):
+        df = pd.DataFrame(data=y, index=ids, columns=[name])
+        predictions.append(Prediction(df))
+    return merge_predictions(predictions, dtype=dtype)
+
+
+def load_prediction_mmap(dirname, mode='r'):
+    """
+    Load a prediction saved with ``prediction.save_mmap`` as a memory map.
+
+    The predictions are not read into memory; the operating system pages
+    them in as they are accessed. Methods such as ``performance``,
+    ``dominance``, ``correlation`` and ``originality`` stream over chunks
+    of names so that the full prediction need not fit in memory.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory in which the prediction was saved.
+    mode : str, optional
+        Memory map mode. The default ('r') is read only; with 'r+' changes
+        to prediction.y are written to disk; with 'c' (copy on write)
+        changes are kept in memory only.
+
+    Returns
+    -------
+    prediction : Prediction
+        Prediction object whose data is memory mapped.
+    """
+    ids = np.load(os.path.join(dirname, MMAP_IDS_FILE))
+    names = np.load(os.path.join(dirname, MMAP_NAMES_FILE))
+    y = np.load(os.path.join(dirname, MMAP_Y_FILE), mmap_mode=mode)
+    df = pd.DataFrame(y, index=ids.astype(object), columns=names.tolist(),
+                      copy=False)
     return Prediction(df)
 
 
-def merge_predictions(prediction_list):
+def _csv_name(filename):
+    "Prediction name from file name: strip directory and csv extension"
+    name = os.path.split(filename)[-1]
+    for ext in ('.csv.gz', '.csv'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _read_prediction_csv(filename):
+    "ids (object array) and float64 y of a Numerai csv tournament file"
+    columns = pd.read_csv(filename, nrows=0).columns
+    if 'id' not in columns:
+        raise ValueError("csv file must contain an `id` column")
+    if columns.size != 2:
+        raise ValueError("csv file must contain one column of predictions")
+    # fixed dtypes skip type inference; reading id as a column rather than
+    # as the index skips pandas' index type inference too
+    name = columns[0] if columns[1] == 'id' else columns[1]
+    dtype = {'id': object, name: np.float64}
+    df = pd.read_csv(filename, dtype=dtype, engine=CSV_ENGINE)
+    return df['id'].values, df[name].values
+
+
+def _csv_bytes(ids, y, decimals=6):
+    """
+    Numerai csv file (header id,probability) of one column of predictions.
+
+    The file is assembled as a 2d array of bytes, one row per line, padded
+    with null bytes that are then dropped; nothing is formatted per element
+    in python.
+    """
+    ids = _ascii_matrix(ids)
+    values = _float_matrix(y, decimals)
+    n = ids.shape[0]
+    sep = np.empty((n, 1), dtype=np.uint8)
+    sep.fill(ord(','))
+    eol = np.empty((n, 1), dtype=np.uint8)
+    eol.fill(ord('\n'))
+    lines = np.hstack((ids, sep, values, eol)).ravel()
+    return b'id,probability\n' + lines[lines != 0].tobytes()
+
+
+def _ascii_matrix(ids):
+    "2d uint8 array of the (utf-8 encoded) ids padded with null bytes"
+    ids = np.asarray(ids)
+    try:
+        ids = ids.astype(bytes)
+    except UnicodeEncodeError:
+        ids = np.char.encode(ids.astype(str), 'utf-8')
+    width = max(ids.dtype.itemsize, 1)
+    return ids.astype('S{}'.format(width)).view(np.uint8).reshape(-1, width)
+
+
+def _float_matrix(y, decimals=6):
+    """
+    2d uint8 array of '%.{decimals}f' formatted `y` padded with null bytes.
+
+    Digits are computed with integer arithmetic. NaN is written as an empty
+    string. Non-finite values and values too large for exact integer
+    arithmetic fall back to python formatting. So do values whose scaled
+    product lies within a few ulps of a rounding tie, since rounding the
+    inexact product could then disagree with '%f' formatting.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    nan = np.isnan(y)
+    scale = 10 ** decimals
+    a = np.abs(np.where(nan, 0.0, y)) * scale
+    if a.size and not a.max() < 2 ** 53:
+        fmt = '%.{}f'.format(decimals)
+        out = [b'' if f else (fmt % v).encode() for v, f in zip(y, nan)]
+        return _ascii_matrix(np.array(out, dtype=bytes))
+    tie = np.abs(a - np.floor(a) - 0.5) <= 4 * np.spacing(a)
+    a = np.rint(a).astype(np.int64)
+    if tie.any():
+        fmt = '%.{}f'.format(decimals)
+        a[tie] = [int((fmt % v).replace('.', '')) for v in np.abs(y[tie])]
+    ipart = a // scale
+    ndigits = 1
+    while (ipart >= 10 ** ndigits).any():
+        ndigits += 1
+    width = 1 + ndigits + (decimals + 1 if decimals > 0 else 0)
+    m = np.zeros((y.size, width), dtype=np.uint8)
+    m[:, 0] = np.where(np.signbit(y), ord('-'), 0)
+    for j in range(ndigits):
+        digit = (ipart // 10 ** j) % 10
+        m[:, ndigits - j] = np.where((ipart >= 10 ** j) | (j == 0),
+                                     digit + ord('0'), 0)
+    if decimals > 0:
+        m[:, ndigits + 1] = ord('.')
+        fpart = a % scale
+        for j in range(decimals):
+            m[:, width - 1 - j] = (fpart // 10 ** j) % 10 + ord('0')
+    m[nan] = 0
+    return m
+
+
+def _write_bytes(path_or_buf, data, compress=False):
+    "Write bytes to file path (optionally gzip compressed) or open buffer"
+    if hasattr(path_or_buf, 'write'):
+        if compress:
+            raise ValueError("`compress` requires a file path")
+        if isinstance(path_or_buf, io.TextIOBase):
+            data = data.decode('utf-8')
+        path_or_buf.write(data)
+        return
+    if compress:
+        f = gzip.open(path_or_buf, 'wb')
+    else:
+        f = io.open(path_or_buf, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def _write_mmap(dirname, prediction, dtype=None):
+    "Save prediction to dirname as npy files; y is saved a chunk at a time"
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if dtype is None:
+        dtype = prediction.df.values.dtype
+    np.save(os.path.join(dirname, MMAP_IDS_FILE), prediction.ids.astype(str))
+    np.save(os.path.join(dirname, MMAP_NAMES_FILE),
+            np.array(prediction.names, dtype=str))
+    y = np.lib.format.open_memmap(os.path.join(dirname, MMAP_Y_FILE),
+                                  mode='w+', dtype=dtype,
+                                  shape=prediction.shape, fortran_order=True)
+    for p, i in _chunks_with_offset(prediction):
+        y[:, i:i + p.shape[1]] = p.y
+    y.flush()
+    del y
+
+
+def _append_mmap(dirname, prediction):
+    "Append names of prediction to the end of the npy files in dirname"
+    ids = np.load(os.path.join(dirname, MMAP_IDS_FILE))
+    names = np.load(os.path.join(dirname, MMAP_NAMES_FILE)).tolist()
+    if len(set(names) & set(prediction.names)) > 0:
+        raise ValueError("Cannot append names that are already saved")
+    index = pd.Index(ids.astype(object))
+    if (index.get_indexer(prediction.df.index) == -1).any():
+        raise ValueError("Can only append ids that are already saved")
+    idx = prediction.df.index.get_indexer(index)
+    missing = idx == -1
+
+    path = os.path.join(dirname, MMAP_Y_FILE)
+    y = np.load(path, mmap_mode='r')
+    nrows, ncols = y.shape
+    dtype = y.dtype
+    offset = y.offset
+    fortran_order = y.flags.f_contiguous
+    shape = (nrows, ncols + prediction.shape[1])
+    header = io.BytesIO()
+    d = {'descr': np.lib.format.dtype_to_descr(dtype),
+         'fortran_order': True,
+         'shape': shape}
+    np.lib.format.write_array_header_1_0(header, d)
+    header = header.getvalue()
+
+    def aligned(p):
+        "Rows of p in the order of the saved ids"
+        yp = p.y[idx].astype(dtype)
+        yp[missing] = np.nan
+        return yp
+
+    if fortran_order and len(header) == offset:
+        # new names are written to the end of the (column major) file;
+        # then the header is updated with the new shape
+        del y
+        with open(path, 'r+b') as f:
+            f.seek(0, 2)
+            for p, i in _chunks_with_offset(prediction):
+                f.write(aligned(p).tobytes(order='F'))
+            f.seek(0)
+            f.write(header)
+    else:
+        # the header can't grow in place (rare); copy to a new file
+        tmp = path + '.tmp'
+        ynew = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype,
+                                         shape=shape, fortran_order=True)
+        colchunk = max(1, CHUNK_NBYTES // (8 * max(1, nrows)))
+        for i in range(0, ncols, colchunk):
+            j = min(i + colchunk, ncols)
+            ynew[:, i:j] = y[:, i:j]
+        for p, i in _chunks_with_offset(prediction):
+            ynew[:, ncols + i:ncols + i + p.shape[1]] = aligned(p)
+        ynew.flush()
+        del y, ynew
+        os.remove(path)
+        os.rename(tmp, path)
+
+    np.save(os.path.join(dirname, MMAP_NAMES_FILE),
+            np.array(names + prediction.names, dtype=str))
+
+
+def _chunks_with_offset(prediction):
+    "Yield chunks of names of prediction and the column offset of the chunk"
+    i = 0
+    for p in prediction._iter_chunks():
+        yield p, i
+        i += p.shape[1]
+
+
+def _hdf_store(path_or_buf, mode, compress=False):
+    "HDFStore and whether the caller should close it when done"
+    if isinstance(path_or_buf, pd.HDFStore):
+        return path_or_buf, False
+    if compress:
+        store = pd.HDFStore(path_or_buf, mode=mode, complib='zlib',
+                            complevel=4)
+    else:
+        store = pd.HDFStore(path_or_buf, mode=mode)
+    return store, True
+
+
+def _write_hdf(store, prediction):
+    "Write prediction to an hdf store, replacing any prediction already there"
+    for key in (HDF_PREDICTION_KEY, HDF_IDS_KEY, HDF_NAMES_KEY):
+        if key in store:
+            store.remove(key)
+    handle, _ = _hdf_handle(store)
+    if '/' + HDF_Y_KEY in handle:
+        handle.remove_node('/' + HDF_Y_KEY, recursive=True)
+    _put_ids(store, prediction.df.index)
+    names = prediction.names
+    store.put(HDF_NAMES_KEY, pd.Series(np.arange(len(names)), index=names))
+    y = prediction.y
+    for j in range(y.shape[1]):
+        _write_hdf_column(store, j, y[:, j])
+
+
+def _append_hdf(store, prediction, replace=False):
+    "Append prediction to hdf store; only the ids and its names are written"
+    index = store.get(HDF_IDS_KEY).index
+    names = store.get(HDF_NAMES_KEY)
+
+    # append new ids to the shared id table; old ids keep their positions
+    idx = index.get_indexer(prediction.df.index)
+    new = idx == -1
+    if new.any():
+        idx[new] = index.size + np.arange(new.sum())
+        index = index.append(prediction.df.index[new])
+        _put_ids(store, index)
+
+    y = prediction.y
+    for j, name in enumerate(prediction.names):
+        yj = y[:, j]
+        keep = ~np.isnan(yj)
+        if name in names and replace:
+            i = names[name]
+            col = np.empty(index.size, dtype=yj.dtype)
+            col.fill(np.nan)
+        elif name in names:
+            i = names[name]
+            col = _read_hdf_column(store, i, index.size)
+            if not np.isnan(col[idx[keep]]).all():
+                msg = "overlap in predictions of `{}` (same name and id)"
+                raise ValueError(msg.format(name))
+        else:
+            i = names.size
+            names[name] = i
+            col = np.empty(index.size, dtype=yj.dtype)
+            col.fill(np.nan)
+        col[idx[keep]] = yj[keep]
+        _write_hdf_column(store, i, col)
+    store.put(HDF_NAMES_KEY, names)
+
+
+def _put_ids(store, index):
+    "Store ids as the index of a series that maps id to row number"
+    store.put(HDF_IDS_KEY, pd.Series(np.arange(index.size), index=index))
+
+
+def _write_hdf_column(store, i, y):
+    "Write 1d array `y` as the i-th column (a chunked array) of hdf store"
+    handle, filters = _hdf_handle(store)
+    where = '/' + HDF_Y_KEY
+    name = 'y' + str(i)
+    if where + '/' + name in handle:
+        handle.remove_node(where, name)
+    handle.create_carray(where, name, obj=y, filters=filters,
+                         createparents=True)
+
+
+def _hdf_column(store, i):
+    "The i-th column (a PyTables array) of hdf store"
+    return store.get_node('/' + HDF_Y_KEY + '/y' + str(i))
+
+
+def _hdf_handle(store):
+    """
+    PyTables file handle and compression filters of an open HDFStore.
+
+    pandas has no public API for these, so this is the one place that
+    reaches into the store's private attributes. They have been stable
+    across pandas versions; if they ever go away a clear error is raised
+    rather than an AttributeError deep inside a save.
+    """
+    handle = getattr(store, '_handle', None)
+    if handle is None or not hasattr(store, '_filters'):
+        msg = "pandas {} does not expose the hdf file handle numerox needs"
+        raise RuntimeError(msg.format(pd.__version__))
+    return handle, store._filters
+
+
+def _read_hdf_column(store, i, nrows):
+    "Read i-th column from hdf store; pad with NaN to `nrows` rows"
+    y = _hdf_column(store, i).read()
+    if y.size < nrows:
+        # column was written before more ids were appended to the archive
+        pad = np.empty(nrows - y.size, dtype=y.dtype)
+        pad.fill(np.nan)
+        y = np.concatenate((y, pad))
+    return y
+
+
+def merge_predictions(prediction_list, dtype=None):
     """
     Merge a list of predictions.
 
     Raises ValueError on overlapping predictions (same model name and same
     row id).
+
+    The dtype of the merged prediction is `dtype` or, by default (None),
+    the smallest float dtype that can hold all of the predictions.
+
+    The merge is done in a single pass: the union of the row ids is found
+    once and then every column is scattered into a preallocated array. As
+    with an outer join, the ids are sorted unless all predictions have the
+    same ids in the same order.
     """
-    p = prediction_list[0].copy()
-    for i in range(1, len(prediction_list)):
-        pi = prediction_list[i]
-        for name in pi.names:
-            p = _merge_predictions(p, pi[name])
-    return p
-
-
-def _merge_predictions(prediction1, prediction2):
-    "Merge a possibly multi-name prediction1 with a single-name prediction2"
-    if prediction2.shape[1] != 1:
-        raise ValueError("`prediction2` must contain a signle name")
-    name = prediction2.names[0]
-    if prediction1.df is None:
-        # empty prediction
-        df = prediction2.df
-    elif name not in prediction1:
-        # inserting predictions from a model not already in report
-        df = pd.merge(prediction1.df, prediction2.df, how='outer',
-                      left_index=True, right_index=True)
+
+    predictions = [p for p in prediction_list if p.size > 0]
+    if len(predictions) == 0:
+        return Prediction(None)
+
+    # union of ids; new ids are appended so that positions never change
+    base = predictions[0].df.index
+    union = base
+    indexers = []
+    for p in predictions:
+        index = p.df.index
+        if index is base or _index_equal(index, base):
+            indexers.append(None)
+        else:
+            idx = union.get_indexer(index)
+            new = idx == -1
+            if new.any():
+                idx[new] = union.size + np.arange(new.sum())
+                union = union.append(index[new])
+            indexers.append(idx)
+
+    # sort ids (as an outer join would) unless all ids are aligned
+    if union is base and all(idx is None for idx in indexers):
+        index = base.copy(deep=True)
+        aligned = True
     else:
-        # add more ys from a model whose name already exists
-        y = prediction1.df[name]
-        y = y.dropna()
-        s = prediction2.df.iloc[:, 0]
-        s = s.dropna()
-        s = pd.concat([s, y], join='outer', ignore_index=False,
-                      verify_integrity=True)
-        dfnew = s.to_frame(name)
-        df = pd.merge(prediction1.df, dfnew, how='outer', on=name,
-                      left_index=True, right_index=True)
-        df[name] = dfnew
+        order = union.argsort()
+        index = union[order]
+        rank = np.empty(order.size, dtype=np.intp)
+        rank[order] = np.arange(order.size)
+        aligned = False
+
+    # names in order of first appearance
+    names = []
+    for p in predictions:
+        for name in p.names:
+            if name not in names:
+                names.append(name)
+    columns = dict(zip(names, range(len(names))))
+
+    # scatter each column into a (fortran ordered) array
+    if dtype is None:
+        dtypes = [p.df.dtypes.values for p in predictions]
+        dtype = np.result_type(np.float16, *np.concatenate(dtypes))
+    y = np.empty((index.size, len(names)), dtype=dtype, order='F')
+    y.fill(np.nan)
+    filled = set()
+    for p, idx in zip(predictions, indexers):
+        if aligned:
+            rows = None
+        elif idx is None:
+            rows = rank[:base.size]
+        else:
+            rows = rank[idx]
+        yp = p.y
+        for j, name in enumerate(p.names):
+            yj = yp[:, j]
+            col = y[:, columns[name]]
+            isnan = np.isnan(yj)
+            if isnan.any():
+                keep = ~isnan
+                yj = yj[keep]
+                r = np.flatnonzero(keep) if rows is None else rows[keep]
+            else:
+                r = rows
+            if name in filled:
+                overlap = col[r] if r is not None else col
+                if not np.isnan(overlap).all():
+                    msg = "overlap in predictions of `{}` (same name and id)"
+                    raise ValueError(msg.format(name))
+            if r is None:
+                col[:] = yj
+            else:
+                col[r] = yj
+            filled.add(name)
+
+    df = pd.DataFrame(data=y, index=index, columns=names)
+
     return Prediction(df)
+
+
+def _index_equal(index1, index2):
+    "True if two pandas indexes contain the same ids in the same order"
+    if index1.size != index2.size:
+        return False
+    a1 = index1.values
+    a2 = index2.values
+    if not (a1[:100] == a2[:100]).all():
+        # cheap check that avoids comparing every id of unaligned indexes
+        return False
+    if a1.dtype == object and a2.dtype == object:
+        # ids taken from the same data are the same python objects; their
+        # addresses are compared in one vectorized pass so that only the
+        # remaining ids are compared by value
+        differ = _addresses(a1) != _addresses(a2)
+        a1 = a1[differ]
+        a2 = a2[differ]
+    return bool((a1 == a2).all())
+
+
+def _addresses(a):
+    "Addresses of the python objects in a 1d object array"
+    a = np.ascontiguousarray(a)
+    return np.ndarray(a.shape, dtype=np.intp, buffer=a)
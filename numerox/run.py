@@ -1,26 +1,138 @@
+import os
+import sys
 import time
 import pprint
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # py2
+try:
+    import resource
+except ImportError:
+    resource = None  # windows
 
-from numerox import Prediction, TournamentSplitter, CVSplitter
+import numpy as np
+import pandas as pd
 
+from numerox import TournamentSplitter, CVSplitter
+from numerox.splitter import _take
+from numerox.prediction import Prediction
+from numerox.prediction import PredictionBuilder
+from numerox.prediction import merge_predictions
+from numerox.metrics import logloss_per_era, LOGLOSS_BENCHMARK
 
-def production(model, data, name=None, verbosity=2):
+
+def production(model, data, name=None, verbosity=2, n_jobs=1,
+               executor='process', timeout=None):
     "Fit a model with train data; make prediction on tournament data"
     splitter = TournamentSplitter(data)
-    prediction = run(model, splitter, name, verbosity=verbosity)
+    prediction = run(model, splitter, name, verbosity=verbosity,
+                     n_jobs=n_jobs, executor=executor, timeout=timeout)
     return prediction
 
 
-def backtest(model, data, name=None, kfold=5, seed=0, verbosity=2):
+def backtest(model, data, name=None, kfold=5, seed=0, verbosity=2, n_jobs=1,
+             executor='process', checkpoint=None, fold_timeout=None,
+             timeout=None, early_stop=None):
     "K-fold cross validation of model through train data"
     splitter = CVSplitter(data, kfold=kfold, seed=seed, train_only=True)
-    prediction = run(model, splitter, name, verbosity)
+    prediction = run(model, splitter, name, verbosity, n_jobs=n_jobs,
+                     executor=executor, checkpoint=checkpoint,
+                     fold_timeout=fold_timeout, timeout=timeout,
+                     early_stop=early_stop)
     return prediction
 
 
-def run(model, splitter, name=None, verbosity=2):
-    "Run a single model through a data splitter"
+def run(model, splitter, name=None, verbosity=2, n_jobs=1,
+        executor='process', checkpoint=None, timing=False, fold_timeout=None,
+        timeout=None, early_stop=None):
+    """
+    Run a single model through a data splitter.
+
+    Parameters
+    ----------
+    model : nx.Model
+        Model to fit and predict with.
+    splitter : Splitter
+        Data splitter that yields the (fit, predict) data of each fold.
+    name : {str, None}, optional
+        Name of the prediction. By default (None) the class name of the
+        model is used.
+    verbosity : int, optional
+        0 prints nothing; 1 prints the model and a final summary; 2 (default)
+        adds a summary after each fold and the run time; 3 adds the name and
+        splitter.
+    n_jobs : int, optional
+        Number of folds to fit and predict concurrently. Default is 1.
+    executor : str, optional
+        With 'process' (default) each fold runs in its own process. On
+        platforms that fork (Linux, macOS with py2) the fold's data is
+        inherited by the process rather than pickled; only the predictions
+        are sent back. With 'thread' the folds run in a pool of threads,
+        which only helps models that release the GIL.
+    checkpoint : {str, None}, optional
+        Directory in which to save the prediction of each fold as soon as
+        it is made (on a background thread). If the run is interrupted then
+        rerunning it with the same checkpoint directory loads the saved
+        folds instead of fitting them again. Folds are saved under a key
+        made from the model, the splitter, and the content of the data so
+        one directory can hold the checkpoints of many runs. The key uses
+        the repr of the model and of the splitter, so a ValueError is
+        raised if either repr contains a memory address (the default repr
+        of a model that does not subclass nx.Model). By default (None)
+        nothing is saved.
+    timing : bool, optional
+        If True then also return a report of the wall time, CPU time and
+        increase in peak memory (RSS) of each stage of each fold. The
+        stages are 'split' (making the fold data), 'y_to_nan',
+        'fit_predict' (or 'load' from a checkpoint), 'append' (adding the
+        fold to the prediction) and 'summary' (verbosity > 1). The
+        fit_predict stage is measured where it runs, e.g. in the child
+        process; with executor='thread' its CPU time includes that of the
+        other threads. Default is False, which adds no overhead.
+    fold_timeout : {float, None}, optional
+        Seconds that the fit and predict of a fold may take. A fold that
+        takes longer is cancelled (its process is terminated) and left out
+        of the prediction; the other folds still run. Needs
+        executor='process'; the fold then runs in a child process even if
+        `n_jobs` is 1. By default (None) there is no limit.
+    timeout : {float, None}, optional
+        Seconds that the whole run may take. Once the time is up the folds
+        still running are cancelled, no more folds are started and the
+        folds that finished are returned. Needs executor='process'. By
+        default (None) there is no limit.
+    early_stop : {float, None}, optional
+        Significance level of a test, made after each fold, of whether the
+        logloss of the eras predicted so far is worse than
+        LOGLOSS_BENCHMARK. If it is then the remaining folds are not run.
+        The test is an exact one-sided sign test: it rejects when too many
+        eras have a logloss above the benchmark to be chance. Eras without
+        targets (e.g. tournament eras) are ignored. For example 0.01. By
+        default (None) all folds are run.
+
+    Returns
+    -------
+    prediction : Prediction
+        The fold predictions are merged in fold order so the prediction is
+        the same whatever `n_jobs` is. If a fold was cancelled or left out
+        (see `fold_timeout`, `timeout` and `early_stop`) then
+        `prediction.partial` is True.
+    report : pandas.DataFrame
+        Only returned if `timing` is True. One row per fold and stage with
+        columns fold, stage, wall and cpu (seconds) and rss (MB).
+    """
     t0 = time.time()
+    report = [] if timing else None
+    budget = None
+    if fold_timeout is not None or timeout is not None:
+        budget = _Budget(fold_timeout, timeout, t0)
+    era_logloss = []
+    stopped = False
     if name is None:
         name = model.__class__.__name__
     else:
@@ -31,23 +143,524 @@ def run(model, splitter, name=None, verbosity=2):
     if verbosity > 0:
         pprint.pprint(model)
     data = None
-    prediction = Prediction()
-    for data_fit, data_predict in splitter:
+    builder = PredictionBuilder(name, getattr(splitter, 'nrows', 0))
+    folds = _fit_predict_folds([model], splitter, n_jobs, executor,
+                               checkpoint, report, budget)
+    for data_predict, i, j, ids, yhat in folds:
         if verbosity > 0:
             if data is None:
                 data = data_predict.copy()
             else:
                 data = data + data_predict
-        # the following line of code hides from your model the y
-        # that you are trying to predict to prevent accidental cheating
-        data_predict = data_predict.y_to_nan()
-        ids, yhat = model.fit_predict(data_fit, data_predict)
-        prediction = prediction.merge_arrays(ids, yhat, name)
+        _timed(report, i, 'append', builder.append, ids, yhat)
         if verbosity > 1:
-            print(prediction.summary(data.region_isnotin(['test', 'live'])))
-    if verbosity == 1:
+            _timed(report, i, 'summary', _print_summary, builder, data)
+        if early_stop is not None:
+            era_logloss.append(_era_logloss(data_predict, ids, yhat))
+            if _worse_than_benchmark(era_logloss, early_stop):
+                plan = getattr(splitter, 'plan', None)
+                stopped = plan is None or i + 1 < len(plan())
+                break
+    folds.close()
+    prediction = _timed(report, None, 'prediction', builder.prediction)
+    prediction.partial = stopped or (budget is not None and budget.partial)
+    if verbosity > 0 and prediction.partial:
+        if stopped:
+            print('Stopped early: logloss worse than benchmark')
+        else:
+            print('Partial prediction: some folds ran out of time')
+    if verbosity == 1 and data is not None:
         print(prediction.summary(data.region_isnotin(['test', 'live'])))
     if verbosity > 1:
         minutes = (time.time() - t0) / 60
         print('Done in {:.2f} minutes'.format(minutes))
+    if timing:
+        report.append({'fold': None, 'stage': 'total',
+                       'wall': time.time() - t0, 'cpu': np.nan,
+                       'rss': np.nan})
+        columns = ['fold', 'stage', 'wall', 'cpu', 'rss']
+        return prediction, pd.DataFrame(report, columns=columns)
+    return prediction
+
+
+def _print_summary(builder, data):
+    "Print summary of the folds of the prediction made so far"
+    prediction = builder.prediction()
+    print(prediction.summary(data.region_isnotin(['test', 'live'])))
+
+
+def run_many(models, splitter, names=None, verbosity=1, n_jobs=1,
+             executor='process', checkpoint=None):
+    """
+    Run several models through a data splitter.
+
+    Each fold of the splitter is made once and given to every model, which
+    saves the cost of making the folds again for each model, as separate
+    calls to ``run`` would.
+
+    Parameters
+    ----------
+    models : list
+        List of nx.Model objects.
+    splitter : Splitter
+        Data splitter that yields the (fit, predict) data of each fold.
+    names : {list, None}, optional
+        Name of each model's prediction. By default (None) the class names
+        of the models are used; they must then be unique.
+    verbosity : int, optional
+        0 prints nothing; 1 (default) prints the performance of the models;
+        2 adds the run time.
+    n_jobs : int, optional
+        Number of (model, fold) tasks to run concurrently. Default is 1.
+    executor : str, optional
+        Either 'process' (default) or 'thread'. See ``run``.
+    checkpoint : {str, None}, optional
+        Directory in which to checkpoint each (model, fold). See ``run``.
+
+    Returns
+    -------
+    prediction : Prediction
+        The predictions of all models. The fold predictions are merged in
+        fold order so the prediction is the same whatever `n_jobs` is.
+    """
+    t0 = time.time()
+    if names is None:
+        names = [model.__class__.__name__ for model in models]
+    if len(names) != len(models):
+        raise ValueError("`names` must contain one name per model")
+    if len(set(names)) != len(names):
+        raise ValueError("model names must be unique; use `names`")
+    data = None
+    nrows = getattr(splitter, 'nrows', 0)
+    builders = [PredictionBuilder(name, nrows) for name in names]
+    folds = _fit_predict_folds(models, splitter, n_jobs, executor,
+                               checkpoint)
+    for data_predict, i, j, ids, yhat in folds:
+        if verbosity > 0 and j == 0:
+            if data is None:
+                data = data_predict.copy()
+            else:
+                data = data + data_predict
+        builders[j].append(ids, yhat)
+    prediction = merge_predictions([b.prediction() for b in builders])
+    if verbosity > 0:
+        print(prediction.performance(data.region_isnotin(['test', 'live'])))
+    if verbosity > 1:
+        minutes = (time.time() - t0) / 60
+        print('Done in {:.2f} minutes'.format(minutes))
     return prediction
+
+
+def _fit_predict_folds(models, splitter, n_jobs=1, executor='process',
+                       checkpoint=None, report=None, budget=None,
+                       by_model=False, model_folds=None):
+    """
+    Yield (data_predict, i, j, ids, yhat) of each fold i and each model j.
+
+    By default folds are made once and given to every model. Results are
+    yielded in fold order and, within a fold, in model order. Up to
+    `n_jobs` (model, fold) tasks run concurrently (see ``run``) while the
+    splitter lazily makes the next folds.
+
+    If `by_model` is True then the tasks are instead run model by model so
+    that each model's folds finish together. Each task makes its fold from
+    the row indices of the splitter's plan where it runs (a child process
+    inherits the splitter's data rather than the fold's), so data_predict
+    is None. `model_folds[j]` lists the indices, into the plan, of the folds
+    of model j; by default (None) each model runs every fold.
+
+    Folds found in the `checkpoint` directory are loaded instead of fit. If
+    `report` is a list then the time and memory use of each stage is
+    appended to it. If a `budget` is given then folds that run out of time
+    are cancelled and not yielded.
+    """
+    if executor not in ('process', 'thread'):
+        raise ValueError("`executor` must be 'process' or 'thread'")
+    if budget is not None and executor != 'process':
+        raise ValueError("time budgets need executor='process'")
+    timed = report is not None
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = _Checkpoint(checkpoint, models, splitter)
+    pool = None
+    if n_jobs > 1 and executor == 'thread':
+        pool = ThreadPool(n_jobs)
+    if by_model:
+        work = _plan_tasks(models, splitter, model_folds, timed)
+    else:
+        work = _fold_tasks(models, splitter, report)
+    tasks = deque()
+    try:
+        for data_predict, i, j, func, args in work:
+            if budget is not None and budget.expired():
+                budget.partial = True
+                break
+            if ckpt is not None and ckpt.exists(i, j):
+                task = _LoadTask(ckpt, i, j, timed)
+            elif budget is not None:
+                # in a process, even if n_jobs=1, so it can be cancelled
+                task = _ProcessTask(func, *args)
+            else:
+                task = _start_task(pool, n_jobs, func, *args)
+            tasks.append((data_predict, i, j, task))
+            if len(tasks) >= n_jobs:
+                result = _task_result(tasks.popleft(), ckpt, report, budget)
+                if result is not None:
+                    yield result
+        while tasks:
+            result = _task_result(tasks.popleft(), ckpt, report, budget)
+            if result is not None:
+                yield result
+    finally:
+        for task_tuple in tasks:
+            if isinstance(task_tuple[-1], _ProcessTask):
+                task_tuple[-1].cancel()
+        if pool is not None:
+            pool.close()
+        if ckpt is not None:
+            ckpt.close()
+
+
+def _fold_tasks(models, splitter, report=None):
+    "Yield (data_predict, i, j, func, args) of tasks, making each fold once"
+    timed = report is not None
+    if timed:
+        splitter = _timed_splits(splitter, report)
+    for i, (data_fit, data_predict) in enumerate(splitter):
+        # the following line of code hides from your model the y
+        # that you are trying to predict to prevent accidental cheating
+        data_hidden = _timed(report, i, 'y_to_nan', data_predict.y_to_nan)
+        for j, model in enumerate(models):
+            args = (model, data_fit, data_hidden, timed)
+            yield data_predict, i, j, _fit_predict, args
+
+
+def _plan_tasks(models, splitter, model_folds=None, timed=False):
+    "Yield (None, i, j, func, args) of tasks that make folds from the plan"
+    data = splitter._data()
+    plan = splitter.plan()
+    for j, model in enumerate(models):
+        folds = range(len(plan)) if model_folds is None else model_folds[j]
+        for i in folds:
+            fit_index, predict_index = plan[i]
+            args = (model, data, fit_index, predict_index, timed)
+            yield None, i, j, _fit_predict_split, args
+
+
+def _task_result(task_tuple, ckpt, report, budget=None):
+    "Wait for a (model, fold) task; checkpoint its result if fit"
+    data_predict, i, j, task = task_tuple
+    if budget is not None and isinstance(task, _ProcessTask):
+        if not task.ready(budget.wait(task.start)):
+            task.cancel()
+            budget.partial = True
+            return None
+    (ids, yhat), usage = task.get()
+    loaded = isinstance(task, _LoadTask)
+    if ckpt is not None and not loaded:
+        ckpt.save(i, j, ids, yhat)
+    if report is not None:
+        usage['fold'] = i
+        usage['stage'] = 'load' if loaded else 'fit_predict'
+        report.append(usage)
+    return data_predict, i, j, ids, yhat
+
+
+def _fit_predict(model, data_fit, data_predict, timed=False):
+    "(ids, yhat) of model and, if `timed`, its time and memory use"
+    if not timed:
+        return model.fit_predict(data_fit, data_predict), None
+    start = _usage()
+    result = model.fit_predict(data_fit, data_predict)
+    return result, _usage_since(start)
+
+
+def _fit_predict_split(model, data, fit_index, predict_index, timed=False):
+    "Make fold from row indices of data; then as _fit_predict"
+    if timed:
+        start = _usage()
+    data_fit = _take(data, fit_index)
+    # hide from the model the y that it is trying to predict
+    data_predict = _take(data, predict_index).y_to_nan()
+    if not timed:
+        return model.fit_predict(data_fit, data_predict), None
+    result = model.fit_predict(data_fit, data_predict)
+    return result, _usage_since(start)
+
+
+def _start_task(pool, n_jobs, func, *args):
+    "Start func(*args) serially (n_jobs=1), in thread pool or in a process"
+    if n_jobs == 1:
+        return _SerialTask(func, *args)
+    elif pool is None:
+        return _ProcessTask(func, *args)
+    return pool.apply_async(func, args)
+
+
+class _SerialTask(object):
+    "Call func(*args) when get is called"
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def get(self):
+        return self.func(*self.args)
+
+
+class _LoadTask(object):
+    "Load one fold from a checkpoint when get is called"
+
+    def __init__(self, ckpt, i, j, timed=False):
+        self.args = (ckpt, i, j, timed)
+
+    def get(self):
+        ckpt, i, j, timed = self.args
+        if not timed:
+            return ckpt.load(i, j), None
+        start = _usage()
+        result = ckpt.load(i, j)
+        return result, _usage_since(start)
+
+
+class _Budget(object):
+    "Per-fold and total time budgets (seconds) of a run started at `t0`"
+
+    def __init__(self, fold_timeout=None, timeout=None, t0=None):
+        self.fold_timeout = fold_timeout
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = (time.time() if t0 is None else t0) + timeout
+        self.partial = False
+
+    def wait(self, start):
+        "Seconds left to wait for a fold started at `start`; None is forever"
+        waits = []
+        if self.fold_timeout is not None:
+            waits.append(start + self.fold_timeout - time.time())
+        if self.deadline is not None:
+            waits.append(self.deadline - time.time())
+        if not waits:
+            return None
+        return max(0, min(waits))
+
+    def expired(self):
+        "True if the total time budget is used up"
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+def _checkpoint_repr(obj, what):
+    "repr of obj for a checkpoint key; must be the same in every process"
+    r = repr(obj)
+    if ' at 0x' in r:
+        msg = ("checkpoint requires a {0} whose repr does not depend on its "
+               "memory address (got {1}); subclass nx.Model or nx.Splitter "
+               "or define __repr__ from the {0}'s parameters")
+        raise ValueError(msg.format(what, r))
+    return r
+
+
+class _Checkpoint(object):
+    """
+    Directory of fold predictions, one subdirectory per (model, splitter,
+    data) key; files are written by a background thread.
+    """
+
+    def __init__(self, path, models, splitter):
+        digest = splitter._data().digest()
+        self.dirs = []
+        for model in models:
+            key = hashlib.md5()
+            key.update(_checkpoint_repr(model, 'model').encode('utf-8'))
+            key.update(_checkpoint_repr(splitter, 'splitter').encode('utf-8'))
+            key.update(digest.encode('utf-8'))
+            path_key = os.path.join(path, key.hexdigest())
+            if not os.path.isdir(path_key):
+                os.makedirs(path_key)
+            self.dirs.append(path_key)
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def filename(self, i, j):
+        return os.path.join(self.dirs[j], 'fold{}.npz'.format(i))
+
+    def exists(self, i, j):
+        return os.path.exists(self.filename(i, j))
+
+    def load(self, i, j):
+        npz = np.load(self.filename(i, j))
+        try:
+            return npz['ids'].astype(object), npz['yhat']
+        finally:
+            npz.close()
+
+    def save(self, i, j, ids, yhat):
+        "Queue (ids, yhat) of fold i of model j to be written to disk"
+        self.queue.put((self.filename(i, j), ids, yhat))
+
+    def close(self):
+        "Wait for queued folds to be written"
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filename, ids, yhat = item
+            # write to a temporary file then rename so that a fold file is
+            # either complete or missing, never partly written
+            tmp = filename + '.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    np.savez(f, ids=np.asarray(ids).astype(str), yhat=yhat)
+                os.rename(tmp, filename)
+            except Exception as e:
+                self.error = e
+
+
+class _ProcessTask(object):
+    "Call func(*args), e.g. fit and predict one fold, in a child process"
+
+    def __init__(self, func, *args):
+        self.start = time.time()
+        self.conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_task_child,
+                                               args=(func, args, child_conn))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def get(self):
+        "Wait for and return the result of func(*args)"
+        try:
+            result = self.conn.recv()
+        except EOFError:
+            result = RuntimeError("task process died before returning")
+        finally:
+            self.conn.close()
+            self.process.join()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def ready(self, timeout=None):
+        "Wait up to `timeout` seconds (None is forever) for the result"
+        return self.conn.poll(timeout)
+
+    def cancel(self):
+        "Terminate the process without waiting for its result"
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+def _task_child(func, args, conn):
+    "Target of task process: send result (or the exception) to parent"
+    try:
+        result = func(*args)
+    except Exception as e:
+        result = e
+    conn.send(result)
+    conn.close()
+
+
+def _timed(report, fold, stage, func, *args):
+    "Call func(*args); if report is a list, append the stage's resource use"
+    if report is None:
+        return func(*args)
+    start = _usage()
+    result = func(*args)
+    usage = _usage_since(start)
+    usage['fold'] = fold
+    usage['stage'] = stage
+    report.append(usage)
+    return result
+
+
+def _timed_splits(splitter, report):
+    "Yield the splits of splitter, appending the time to make each to report"
+    splits = iter(splitter)
+    i = 0
+    while True:
+        start = _usage()
+        try:
+            split = next(splits)
+        except StopIteration:
+            return
+        usage = _usage_since(start)
+        usage['fold'] = i
+        usage['stage'] = 'split'
+        report.append(usage)
+        yield split
+        i += 1
+
+
+def _usage():
+    "Wall time, CPU time (seconds) and peak RSS (MB) of this process"
+    t = os.times()
+    return time.time(), t[0] + t[1], _peak_rss()
+
+
+def _usage_since(start):
+    "Dict of wall time, CPU time and increase in peak RSS since `start`"
+    now = _usage()
+    return {'wall': now[0] - start[0],
+            'cpu': now[1] - start[1],
+            'rss': now[2] - start[2]}
+
+
+def _peak_rss():
+    "Peak resident set size (MB) of this process; NaN if not available"
+    if resource is None:
+        return np.nan
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024.0 ** 2  # bytes
+    return rss / 1024.0  # kilobytes
+
+
+def _era_logloss(data, ids, yhat):
+    "Logloss of each era of data that has targets, given predictions yhat"
+    name = 'yhat'
+    prediction = Prediction(pd.DataFrame({name: yhat}, index=ids))
+    logloss = logloss_per_era(data, prediction)[name].values
+    return logloss[np.isfinite(logloss)]
+
+
+def _worse_than_benchmark(era_logloss, alpha):
+    """
+    True if logloss is significantly (one-sided, level alpha) worse than
+    LOGLOSS_BENCHMARK in the list of arrays of era logloss.
+
+    Sign test: under the null hypothesis each era is as likely to be
+    above as below the benchmark, so the number of eras above it is
+    binomial(n, 0.5).
+    """
+    logloss = np.concatenate(era_logloss)
+    n = logloss.size
+    if n == 0:
+        return False
+    k = int((logloss > LOGLOSS_BENCHMARK).sum())
+    return _binomial_tail(n, k) < alpha
+
+
+def _binomial_tail(n, k):
+    """
+    Probability of k or more heads in n fair coin tosses.
+
+    The terms are summed in log space so that long runs (n of 1024 or more
+    eras) neither overflow nor loop over huge integers.
+    """
+    # logfact[i] is log(i!)
+    logfact = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, n + 1)))))
+    i = np.arange(k, n + 1)
+    logp = logfact[n] - logfact[i] - logfact[n - i] - n * np.log(2.0)
+    m = logp.max()
+    return float(min(np.exp(m) * np.exp(logp - m).sum(), 1.0))
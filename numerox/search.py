@@ -0,0 +1,447 @@
+import time
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from numerox.metrics import logloss_per_era, logloss_metrics
+from numerox.metrics import metrics_per_name
+from numerox.prediction import Prediction
+from numerox.prediction import PredictionBuilder, merge_predictions
+from numerox.run import _fit_predict_folds, _Budget
+from numerox.splitter import CVSplitter
+from numerox.splitter import _take, _era_index, _join_eras
+
+SCORE_COLUMNS = ['logloss', 'sharpe', 'consis']
+
+
+def sweep(model_class, param_grid, splitter, n_jobs=1, executor='process',
+          keep_prediction=False, callback=None, checkpoint=None,
+          fold_timeout=None, timeout=None, timing=False, verbosity=1):
+    """
+    Run every combination of model parameters through a data splitter.
+
+    Parameters
+    ----------
+    model_class : class
+        A model class, such as nx.logistic, whose parameters are given as
+        keyword arguments and kept in `self.p`.
+    param_grid : {dict, list}
+        Dict with parameter names as keys and lists of values to try as
+        values. Every combination of values is run. A list of such dicts
+        runs the combinations of each dict.
+    splitter : Splitter
+        Data splitter that yields the (fit, predict) data of each fold.
+    n_jobs : int, optional
+        Number of (configuration, fold) tasks to run concurrently. Default
+        is 1.
+    executor : str, optional
+        With 'process' (default) each task runs in its own process which
+        inherits (on platforms that fork) the splitter's data and makes
+        its fold from the splitter's plan; only the predictions are sent
+        back. With 'thread' the tasks run in a pool of threads.
+    keep_prediction : bool, optional
+        If True then also return the prediction of every configuration.
+        Default is False, which only keeps the metrics and so keeps memory
+        use flat no matter how many configurations are swept.
+    callback : {callable, None}, optional
+        Called with the metrics of each configuration (a one-row dataframe
+        like the rows of the returned `metrics`) as soon as all of its folds
+        have finished, e.g. to save the results of a long sweep as they
+        come in. It is called once for every configuration; the metrics of
+        a configuration with a fold that ran out of time are NaN.
+    checkpoint : {str, None}, optional
+        Directory in which to checkpoint each (configuration, fold). A
+        sweep that is interrupted and rerun loads the finished folds. See
+        ``run``.
+    fold_timeout : {float, None}, optional
+        Seconds that a (configuration, fold) task may take. See ``run``.
+    timeout : {float, None}, optional
+        Seconds that the whole sweep may take. See ``run``.
+    timing : bool, optional
+        If True then also return a report of the time and memory use of
+        each task. See ``run``; here the fit_predict stage includes making
+        the fold. Default is False.
+    verbosity : int, optional
+        0 prints nothing; 1 (default) prints the metrics of each
+        configuration as soon as all of its folds have finished; 2 adds the
+        run time.
+
+    Returns
+    -------
+    metrics : pandas.DataFrame
+        One row per configuration, named by the model's repr, with the
+        parameters followed by the logloss, sharpe and consis (across the
+        eras of the predicted rows) as columns. Rows are in grid order.
+        Configurations with a fold that ran out of time have NaN metrics.
+    prediction : Prediction
+        Only returned if `keep_prediction` is True.
+    report : pandas.DataFrame
+        Only returned if `timing` is True.
+    """
+    t0 = time.time()
+    params = param_list(param_grid)
+    models = [model_class(**p) for p in params]
+    names = [repr(model) for model in models]
+    if len(set(names)) != len(names):
+        raise ValueError("model reprs must be unique; keep parameters in "
+                         "`self.p`")
+    keys = _param_keys(params)
+    report = [] if timing else None
+    budget = _budget(fold_timeout, timeout, t0)
+    predictions = [] if keep_prediction else None
+
+    def on_score(j, m):
+        p = pd.DataFrame([params[j]], index=m.index, columns=keys)
+        callback(pd.concat([p, m], axis=1))
+
+    metrics = _score_models(models, names, splitter, n_jobs, executor,
+                            verbosity, predictions,
+                            None if callback is None else on_score,
+                            checkpoint, report, budget)
+    metrics = pd.concat([pd.DataFrame(params, index=names, columns=keys),
+                         metrics], axis=1)
+    if verbosity > 1:
+        minutes = (time.time() - t0) / 60
+        print('Done in {:.2f} minutes'.format(minutes))
+    out = [metrics]
+    if keep_prediction:
+        out.append(merge_predictions(predictions))
+    if timing:
+        columns = ['fold', 'stage', 'wall', 'cpu', 'rss']
+        out.append(pd.DataFrame(report, columns=columns))
+    return out[0] if len(out) == 1 else tuple(out)
+
+
+def successive_halving(model_class, param_grid, data, kfold=5, eta=3,
+                       metric='logloss', seed=0, n_jobs=1,
+                       executor='process', checkpoint=None,
+                       fold_timeout=None, timeout=None, verbosity=1):
+    """
+    Search a grid of model parameters by successive halving over eras.
+
+    All configurations are first cross validated on a small random subset
+    of the train eras. Only the best 1/`eta` of them are promoted to the
+    next rung, which uses `eta` times as many eras (and more folds). The
+    last rung cross validates the `eta` (or fewer) finalists on all train
+    eras with `kfold` folds and the best of them wins. With n
+    configurations there are about log(n) / log(eta) rungs and, since the
+    eras grow as the configurations shrink, each rung costs about as much
+    as cross validating `eta` configurations on all eras. So with eta=3,
+    searching 81 configurations costs about 12 (rather than 81) full cross
+    validations.
+
+    Parameters
+    ----------
+    model_class : class
+        A model class whose parameters are kept in `self.p`. See ``sweep``.
+    param_grid : {dict, list}
+        Parameter grid. See ``sweep``.
+    data : nx.Data
+        Data whose train eras are used in the search.
+    kfold : int, optional
+        Number of cross validation folds in the last rung. Earlier rungs use
+        fewer folds (at least 2) in proportion to their number of eras.
+        Default is 5.
+    eta : int, optional
+        Factor by which the number of configurations shrinks, and the
+        number of eras grows, from one rung to the next. Default is 3.
+    metric : str, optional
+        Metric used to rank configurations: 'logloss' (default, lower is
+        better), 'sharpe' or 'consis' (higher is better).
+    seed : int, optional
+        Seed used to pick the eras of each rung (each rung's eras contain
+        the previous rung's eras) and to make the cross validation folds.
+    n_jobs : int, optional
+        Number of (configuration, fold) tasks to run concurrently.
+    executor : str, optional
+        Either 'process' (default) or 'thread'. See ``sweep``.
+    checkpoint : {str, None}, optional
+        Directory in which to checkpoint each (configuration, fold) of each
+        rung. See ``run``.
+    fold_timeout : {float, None}, optional
+        Seconds that a (configuration, fold) task may take. Configurations
+        with a fold that runs out of time rank last. See ``run``.
+    timeout : {float, None}, optional
+        Seconds that the whole search may take. Configurations not scored
+        in time rank last. See ``run``.
+    verbosity : int, optional
+        0 prints nothing; 1 (default) prints each rung and the metrics of
+        each configuration as it finishes; 2 adds the run time.
+
+    Returns
+    -------
+    model : nx.Model
+        The best of the finalists cross validated on all train eras.
+    report : pandas.DataFrame
+        One row per configuration per rung with rung, number of eras,
+        kfold, the parameters, and logloss, sharpe and consis as columns.
+    """
+    t0 = time.time()
+    if metric not in ('logloss', 'sharpe', 'consis'):
+        raise ValueError("`metric` must be 'logloss', 'sharpe' or 'consis'")
+    if eta < 2:
+        raise ValueError("`eta` must be at least 2")
+    params = param_list(param_grid)
+    models = [model_class(**p) for p in params]
+    names = [repr(model) for model in models]
+    if len(set(names)) != len(names):
+        raise ValueError("model reprs must be unique; keep parameters in "
+                         "`self.p`")
+    keys = _param_keys(params)
+    budget = _budget(fold_timeout, timeout, t0)
+    eras = _era_index(data)
+    nrung = _halving_rungs(len(models), eta)
+    order = np.random.RandomState(seed).permutation(len(eras))
+    alive = list(range(len(models)))
+    reports = []
+    for rung in range(nrung):
+        fraction = float(eta) ** (rung - nrung + 1)
+        k = max(2, int(round(kfold * fraction)))
+        neras = min(len(eras), max(k, int(round(fraction * len(eras)))))
+        data_rung = _take(data, _join_eras(eras, order[:neras]))
+        splitter = CVSplitter(data_rung, kfold=k, seed=seed)
+        if verbosity > 0:
+            msg = 'rung {}: {} configurations, {} eras, {} folds'
+            print(msg.format(rung, len(alive), neras, k))
+        metrics = _score_models([models[j] for j in alive],
+                                [names[j] for j in alive], splitter, n_jobs,
+                                executor, verbosity, checkpoint=checkpoint,
+                                budget=budget)
+        metrics.insert(0, 'rung', rung)
+        metrics.insert(1, 'neras', neras)
+        metrics.insert(2, 'kfold', k)
+        for key in keys:
+            metrics[key] = [params[j].get(key) for j in alive]
+        reports.append(metrics)
+        ascending = metric == 'logloss'
+        rank = metrics[metric].values
+        rank = np.where(np.isnan(rank), np.inf if ascending else -np.inf,
+                        rank)
+        idx = np.argsort(rank if ascending else -rank, kind='mergesort')
+        if rung == nrung - 1:
+            nkeep = 1
+        else:
+            nkeep = int(np.ceil(len(alive) / float(eta)))
+        alive = [alive[i] for i in idx[:nkeep]]
+    columns = ['rung', 'neras', 'kfold'] + keys
+    columns += ['logloss', 'sharpe', 'consis']
+    report = pd.concat(reports)[columns]
+    if verbosity > 0:
+        print('best: {}'.format(names[alive[0]]))
+    if verbosity > 1:
+        minutes = (time.time() - t0) / 60
+        print('Done in {:.2f} minutes'.format(minutes))
+    return models[alive[0]], report
+
+
+def run_repeated(model, splitter, columns=SCORE_COLUMNS, n_jobs=1,
+                 executor='process', checkpoint=None, fold_timeout=None,
+                 timeout=None, verbosity=1):
+    """
+    Performance of a model in each repeat of a RepeatedCVSplitter.
+
+    The (repeat, fold) tasks of the splitter's plan are run like those of
+    ``sweep``. The prediction of each repeat is kept as a column of a
+    single prediction which is then scored for all repeats at once in one
+    grouped per-era pass.
+
+    Parameters
+    ----------
+    model : nx.Model
+        Model to fit and predict with.
+    splitter : RepeatedCVSplitter
+        Splitter whose repeats each predict every row once.
+    columns : list, optional
+        Metrics to report. The default, logloss, sharpe and consis, are
+        scored with a vectorized per-era logloss. Any of the columns of
+        ``prediction.performance`` (e.g. auc, acc, ystd) can be given; all
+        repeats are then scored together by ``metrics_per_name``.
+    n_jobs : int, optional
+        Number of (repeat, fold) tasks to run concurrently. Default is 1.
+    executor : str, optional
+        Either 'process' (default) or 'thread'. See ``sweep``.
+    checkpoint : {str, None}, optional
+        Directory in which to checkpoint each (repeat, fold). See ``run``.
+    fold_timeout : {float, None}, optional
+        Seconds that a (repeat, fold) task may take. See ``run``.
+    timeout : {float, None}, optional
+        Seconds that all repeats may take. See ``run``.
+    verbosity : int, optional
+        0 prints nothing; 1 (default) prints the mean and standard
+        deviation of the metrics across repeats; 2 adds the run time.
+
+    Returns
+    -------
+    metrics : pandas.DataFrame
+        The metrics in `columns` (across the eras of the predicted rows)
+        as columns with one row per repeat; the index is the repeat number.
+        Repeats with a fold that ran out of time have NaN metrics.
+    """
+    t0 = time.time()
+    data = splitter._data()
+    data_score = _take(data, _predicted_rows(splitter.plan(), len(data)))
+    sizes = [len(plan) for plan in splitter.repeat_plans()]
+    starts = np.cumsum([0] + sizes)
+    nrepeat = len(sizes)
+    model_folds = [range(starts[j], starts[j + 1]) for j in range(nrepeat)]
+    models = [model] * nrepeat
+    names = ['repeat{}'.format(i) for i in range(nrepeat)]
+    budget = _budget(fold_timeout, timeout, t0)
+    yhats = np.empty((len(data_score), nrepeat))
+    yhats.fill(np.nan)
+    predictions = _iter_predictions(models, names, splitter, n_jobs,
+                                    executor, checkpoint, None, budget,
+                                    model_folds)
+    for j, prediction in predictions:
+        if prediction is not None:
+            yhats[:, j] = prediction.df.reindex(data_score.ids).values[:, 0]
+    prediction = Prediction(pd.DataFrame(yhats, index=data_score.df.index,
+                                         columns=names))
+    done = [n for j, n in enumerate(names) if not np.isnan(yhats[:, j]).all()]
+    if len(done) == 0:
+        metrics = pd.DataFrame(np.nan, index=names, columns=columns)
+    elif set(columns) <= set(SCORE_COLUMNS):
+        pivot = logloss_per_era(data_score, prediction)
+        metrics = logloss_metrics(pivot)[columns]
+    else:
+        # repeats that ran out of time are left out: their NaN rows would
+        # be dropped from every repeat
+        metrics, _ = metrics_per_name(data_score, prediction[done],
+                                      columns=columns)
+        metrics = metrics.astype(np.float64).reindex(names)
+    metrics.index = pd.Index(np.arange(nrepeat), name='repeat')
+    if verbosity > 0:
+        print(metrics.agg(['mean', 'std']))
+    if verbosity > 1:
+        minutes = (time.time() - t0) / 60
+        print('Done in {:.2f} minutes'.format(minutes))
+    return metrics
+
+
+def param_list(param_grid):
+    "List of parameter dicts, one for each combination in `param_grid`"
+    if isinstance(param_grid, dict):
+        param_grid = [param_grid]
+    params = []
+    for grid in param_grid:
+        keys = list(grid.keys())
+        for values in itertools.product(*[grid[k] for k in keys]):
+            params.append(dict(zip(keys, values)))
+    return params
+
+
+def _param_keys(params):
+    "Parameter names in a list of parameter dicts in order of appearance"
+    keys = []
+    for p in params:
+        keys.extend(k for k in p if k not in keys)
+    return keys
+
+
+def _halving_rungs(ncandidates, eta):
+    "Number of rungs needed to halve (by `eta`) candidates down to `eta`"
+    nrung = 1
+    while ncandidates > eta:
+        ncandidates = int(np.ceil(ncandidates / float(eta)))
+        nrung += 1
+    return nrung
+
+
+def _score_models(models, names, splitter, n_jobs=1, executor='process',
+                  verbosity=1, predictions=None, callback=None,
+                  checkpoint=None, report=None, budget=None):
+    """
+    Dataframe of logloss, sharpe and consis of models through splitter.
+
+    Metrics are across the eras of the rows predicted by the splitter; they
+    are NaN for models with a fold that ran out of time. Each model's
+    metrics are printed (verbosity > 0) and passed to callback(j, metrics)
+    as soon as it finishes. If `predictions` is a list then each finished
+    model's prediction is appended to it.
+    """
+    data = splitter._data()
+    data_score = _take(data, _predicted_rows(splitter.plan(), len(data)))
+    metrics = pd.DataFrame(np.nan, index=names, columns=SCORE_COLUMNS)
+    scores = _iter_predictions(models, names, splitter, n_jobs, executor,
+                               checkpoint, report, budget)
+    for j, prediction in scores:
+        if prediction is None:
+            m = metrics.iloc[[j]]
+        else:
+            m = logloss_metrics(logloss_per_era(data_score, prediction))
+            metrics.iloc[j] = m.iloc[0].values
+            if predictions is not None:
+                predictions.append(prediction)
+        if verbosity > 0:
+            print(_metrics_line(m))
+        if callback is not None:
+            callback(j, m)
+    return metrics
+
+
+def _iter_predictions(models, names, splitter, n_jobs=1, executor='process',
+                      checkpoint=None, report=None, budget=None,
+                      model_folds=None):
+    """
+    Yield (j, prediction) of each model j as soon as its folds are done.
+
+    The (model, fold) tasks are run model by model by ``_fit_predict_folds``
+    with each task making its fold from the splitter's plan. Model j runs
+    the folds `model_folds[j]` (by default all folds). The prediction is
+    None if a fold of the model was cancelled because it ran out of time,
+    including models none of whose folds finished in time, so every model
+    is yielded.
+    """
+    nrows = len(splitter._data())
+    if model_folds is None:
+        nfold = [len(splitter.plan())] * len(models)
+    else:
+        nfold = [len(folds) for folds in model_folds]
+    folds = _fit_predict_folds(models, splitter, n_jobs, executor,
+                               checkpoint, report, budget, by_model=True,
+                               model_folds=model_folds)
+    current = None
+    jnext = 0
+    for _, i, j, ids, yhat in folds:
+        if j != current:
+            if current is not None:
+                yield current, None
+            # models are run in order; those skipped had no fold finish
+            for k in range(jnext, j):
+                yield k, None
+            jnext = j + 1
+            current = j
+            count = 0
+            builder = PredictionBuilder(names[j], nrows)
+        builder.append(ids, yhat)
+        count += 1
+        if count == nfold[j]:
+            yield j, builder.prediction()
+            current = None
+    if current is not None:
+        yield current, None
+    for k in range(jnext, len(models)):
+        yield k, None
+
+
+def _budget(fold_timeout, timeout, t0):
+    "Time budget of a search started at `t0`; None if there are no limits"
+    if fold_timeout is None and timeout is None:
+        return None
+    return _Budget(fold_timeout, timeout, t0)
+
+
+def _predicted_rows(plan, nrows):
+    "Sorted row positions that are predicted by at least one fold of plan"
+    rows = np.arange(nrows)
+    idx = np.concatenate([rows[predict_index] for _, predict_index in plan])
+    return np.unique(idx)
+
+
+def _metrics_line(metrics):
+    "One line printout of the metrics of a configuration"
+    name = metrics.index[0]
+    m = metrics.iloc[0]
+    fmt = '{}  logloss {:.6f}  sharpe {:.4f}  consis {:.4f}'
+    return fmt.format(name, m['logloss'], m['sharpe'], m['consis'])
@@ -1,10 +1,9 @@
-import sys
-
 import numpy as np
 from sklearn.model_selection import KFold
 from sklearn.model_selection import StratifiedKFold
 
 import numerox as nx
+from numerox.data import REGION_STR_TO_FLOAT, TOURNAMENT_REGIONS
 
 
 class Splitter(object):
@@ -12,26 +11,55 @@ class Splitter(object):
 
     def __init__(self, data):
         self.data = data
-        self.max_count = 0
         self.reset()
 
     def reset(self):
         self.count = 0
 
+    def plan(self):
+        """
+        List of (fit_index, predict_index) tuples, one for each split.
+
+        The indices are int arrays (or, for contiguous rows, slices) of the
+        row positions in the data given to the splitter. The plan is
+        computed the first time it is needed and then cached, so iterating
+        through the splitter again (after a `reset`, for example with a
+        different model) does not recompute the splits. The plan contains
+        only numpy arrays and slices and so can be pickled.
+        """
+        plan = getattr(self, '_cached_plan', None)
+        if plan is None:
+            plan = self._plan()
+            self._cached_plan = plan
+        return plan
+
     def __iter__(self):
         return self
 
     def next(self):
-        if self.count > self.max_count:
+        plan = self.plan()
+        if self.count >= len(plan):
             raise StopIteration
-        tup = self.next_split()
+        fit_index, predict_index = plan[self.count]
         self.count += 1
-        return tup
+        data = self._data()
+        return _take(data, fit_index), _take(data, predict_index)
 
     # py3 compat
     def __next__(self):
         return self.next()  # pragma: no cover
 
+    def _data(self):
+        "The data given to the splitter"
+        if hasattr(self, 'p'):
+            return self.p['data']
+        return self.data
+
+    @property
+    def nrows(self):
+        "Number of rows in the data given to the splitter"
+        return len(self._data())
+
     def __repr__(self):
         msg = ""
         splitter = self.__class__.__name__
@@ -51,24 +79,28 @@ class Splitter(object):
 class TournamentSplitter(Splitter):
     "Single split of data into train, tournament"
 
-    def next_split(self):
-        return self.data['train'], self.data['tournament']
+    def _plan(self):
+        fit_index = _region_index(self.data, ['train'])
+        predict_index = _region_index(self.data, TOURNAMENT_REGIONS)
+        return [(fit_index, predict_index)]
 
 
 class ValidationSplitter(Splitter):
     "Single split of data into train, validation"
 
-    def next_split(self):
-        return self.data['train'], self.data['validation']
+    def _plan(self):
+        fit_index = _region_index(self.data, ['train'])
+        predict_index = _region_index(self.data, ['validation'])
+        return [(fit_index, predict_index)]
 
 
 class CheatSplitter(Splitter):
     "Single split of data into train+validation, tournament"
 
-    def next_split(self):
-        dfit = self.data.region_isin(['train', 'validation'])
-        dpre = self.data['validation']
-        return dfit, dpre
+    def _plan(self):
+        fit_index = _region_index(self.data, ['train', 'validation'])
+        predict_index = _region_index(self.data, ['validation'])
+        return [(fit_index, predict_index)]
 
 
 class SplitSplitter(Splitter):
@@ -79,20 +111,17 @@ class SplitSplitter(Splitter):
                   'fit_fraction': fit_fraction,
                   'seed': seed,
                   'train_only': train_only}
-        self.max_count = 0
         self.reset()
 
-    def next_split(self):
-        data = self.p['data']
-        if self.p['train_only']:
-            data = data['train']
-        eras = data.unique_era()
+    def _plan(self):
+        eras = _era_index(self.p['data'], self.p['train_only'])
+        order = np.arange(len(eras))
         rs = np.random.RandomState(self.p['seed'])
-        rs.shuffle(eras)
-        nfit = int(self.p['fit_fraction'] * eras.size + 0.5)
-        dfit = data.era_isin(eras[:nfit])
-        dpre = data.era_isin(eras[nfit:])
-        return dfit, dpre
+        rs.shuffle(order)
+        nfit = int(self.p['fit_fraction'] * len(eras) + 0.5)
+        fit_index = _join_eras(eras, order[:nfit])
+        predict_index = _join_eras(eras, order[nfit:])
+        return [(fit_index, predict_index)]
 
 
 class CVSplitter(Splitter):
@@ -103,29 +132,11 @@ class CVSplitter(Splitter):
                   'kfold': kfold,
                   'seed': seed,
                   'train_only': train_only}
-        self.eras = None
-        self.cv = None
-        self.max_count = kfold
         self.reset()
 
-    def next_split(self):
-        data = self.p['data']
-        if self.count == 0:
-            if self.p['train_only']:
-                data = data['train']
-            self.eras = data.unique_era()
-            cv = KFold(n_splits=self.p['kfold'], random_state=self.p['seed'],
-                       shuffle=True)
-            self.cv = cv.split(self.eras)
-        if sys.version_info[0] == 2:
-            fit_index, predict_index = self.cv.next()
-        else:
-            fit_index, predict_index = self.cv.__next__()  # pragma: no cover
-        era_fit = [self.eras[i] for i in fit_index]
-        era_predict = [self.eras[i] for i in predict_index]
-        dfit = data.era_isin(era_fit)
-        dpre = data.era_isin(era_predict)
-        return dfit, dpre
+    def _plan(self):
+        eras = _era_index(self.p['data'], self.p['train_only'])
+        return _cv_plan(eras, self.p['kfold'], self.p['seed'])
 
 
 class IgnoreEraCVSplitter(Splitter):
@@ -136,68 +147,193 @@ class IgnoreEraCVSplitter(Splitter):
                   'kfold': kfold,
                   'seed': seed,
                   'train_only': train_only}
-        self.cv = None
-        self.max_count = kfold
         self.reset()
 
-    def next_split(self):
+    def _plan(self):
+        index, y = _row_index(self.p['data'], self.p['train_only'])
+        return _stratified_cv_plan(index, y, self.p['kfold'], self.p['seed'])
+
+
+class RepeatedCVSplitter(Splitter):
+    """
+    K-fold cross validation repeated `nrepeat` times with different seeds.
+
+    Repeat i has the splits of CVSplitter (or, if `ignore_era` is True, of
+    IgnoreEraCVSplitter) with seed `seed + i`. The splits of all repeats are
+    planned up front from a single grouping of the rows into eras; `plan`
+    lists the `kfold` splits of the first repeat, then those of the second,
+    and so on. Since each repeat predicts every row the splitter cannot be
+    iterated (e.g. by ``nx.run``); use ``nx.run_repeated`` instead.
+    """
+
+    def __init__(self, data, kfold=5, nrepeat=10, seed=0, train_only=True,
+                 ignore_era=False):
+        self.p = {'data': data,
+                  'kfold': kfold,
+                  'nrepeat': nrepeat,
+                  'seed': seed,
+                  'train_only': train_only,
+                  'ignore_era': ignore_era}
+        self.reset()
+
+    def _plan(self):
         data = self.p['data']
-        if self.count == 0:
-            if self.p['train_only']:
-                data = data['train']
-            cv = StratifiedKFold(n_splits=self.p['kfold'],
-                                 random_state=self.p['seed'],
-                                 shuffle=True)
-            self.cv = cv.split(data.x, data.y)
-        if sys.version_info[0] == 2:
-            fit_index, pre_index = self.cv.next()
+        kfold = self.p['kfold']
+        seeds = range(self.p['seed'], self.p['seed'] + self.p['nrepeat'])
+        plan = []
+        if self.p['ignore_era']:
+            index, y = _row_index(data, self.p['train_only'])
+            for seed in seeds:
+                plan.extend(_stratified_cv_plan(index, y, kfold, seed))
         else:
-            fit_index, pre_index = self.cv.__next__()  # pragma: no cover
-        dfit = nx.Data(data.df.take(fit_index))
-        dpre = nx.Data(data.df.take(pre_index))
-        return dfit, dpre
+            eras = _era_index(data, self.p['train_only'])
+            for seed in seeds:
+                plan.extend(_cv_plan(eras, kfold, seed))
+        return plan
+
+    def next(self):
+        raise TypeError("RepeatedCVSplitter predicts each row once per "
+                        "repeat so it cannot be iterated (e.g. by run); "
+                        "use run_repeated")
+
+    def repeat_plans(self):
+        "List of the plan of each repeat; see `plan`"
+        plan = self.plan()
+        kfold = self.p['kfold']
+        return [plan[i:i + kfold] for i in range(0, len(plan), kfold)]
 
 
 class RollSplitter(Splitter):
-    "Roll forward through consecutive eras to generate fit, train splits"
+    """
+    Roll forward through consecutive eras to generate fit, train splits.
+
+    Each split fits on `fit_window` eras and predicts the following
+    `predict_window` eras; the windows then move forward `step` eras. If
+    `expanding` is True then the fit window always starts at the first era
+    and so grows by `step` eras each split (walk-forward validation).
+
+    Window boundaries are calculated from era row offsets. When each era's
+    rows are contiguous in data (as in Numerai datasets) the splits are
+    views of data (slices of rows) rather than copies.
+    """
 
     def __init__(self, data, fit_window, predict_window, step,
-                 train_only=True):
+                 train_only=True, expanding=False):
         self.p = {'data': data,
                   'fit_window': fit_window,
                   'predict_window': predict_window,
                   'step': step,
-                  'train_only': train_only}
-        self.eras = None
-        self.cv = None
-        self.max_count = np.inf  # prevent Splitter for stoping iteration
+                  'train_only': train_only,
+                  'expanding': expanding}
         self.reset()
 
-    def next_split(self):
-        data = self.p['data']
-        if self.count == 0:
-            if self.p['train_only']:
-                data = data['train']
-            self.eras = data.unique_era()
-        f_idx1 = self.count * self.p['step']
-        f_idx2 = f_idx1 + self.p['fit_window']
-        p_idx1 = f_idx2
-        p_idx2 = p_idx1 + self.p['predict_window']
-        nera = self.eras.size
-        if p_idx2 > nera:
-            raise StopIteration
-        era_fit = []
-        era_pre = []
-        for i in range(nera):
-            n_ifs = 0
-            if i >= f_idx1 and i < f_idx2:
-                era_fit.append(self.eras[i])
-                n_ifs += 1
-            if i >= p_idx1 and i < p_idx2:
-                era_pre.append(self.eras[i])
-                n_ifs += 1
-            if n_ifs > 1:
-                raise RuntimeError("RollSplitter bug!")  # pragma: no cover
-        dfit = data.era_isin(era_fit)
-        dpre = data.era_isin(era_pre)
-        return dfit, dpre
+    def _plan(self):
+        eras = _era_index(self.p['data'], self.p['train_only'])
+        offsets = _era_offsets(eras)
+        fit_window = self.p['fit_window']
+        predict_window = self.p['predict_window']
+        step = self.p['step']
+        nsplits = (len(eras) - fit_window - predict_window) // step + 1
+        plan = []
+        for count in range(max(0, nsplits)):
+            f_idx1 = 0 if self.p['expanding'] else count * step
+            f_idx2 = count * step + fit_window
+            p_idx1 = f_idx2
+            p_idx2 = p_idx1 + predict_window
+            if offsets is None:
+                fit_index = _join_eras(eras, np.arange(f_idx1, f_idx2))
+                predict_index = _join_eras(eras, np.arange(p_idx1, p_idx2))
+            else:
+                fit_index = slice(offsets[f_idx1], offsets[f_idx2])
+                predict_index = slice(offsets[p_idx1], offsets[p_idx2])
+            plan.append((fit_index, predict_index))
+        return plan
+
+
+def _take(data, index):
+    "Data containing the rows at positions `index`; a view if a slice"
+    if isinstance(index, slice):
+        return nx.Data(data.df.iloc[index])
+    return nx.Data(data.df.take(index))
+
+
+def _region_index(data, regions):
+    "Row positions of data in the iterable `regions`"
+    regions = [REGION_STR_TO_FLOAT[r] for r in regions]
+    return np.flatnonzero(np.in1d(data.region_float, regions))
+
+
+def _row_index(data, train_only=True):
+    "Row positions of data (or of train data) and their targets"
+    if train_only:
+        index = _region_index(data, ['train'])
+    else:
+        index = np.arange(len(data))
+    return index, data.y[index]
+
+
+def _cv_plan(eras, kfold, seed):
+    "Plan of k-fold cross validation across the eras in list `eras`"
+    cv = KFold(n_splits=kfold, random_state=seed, shuffle=True)
+    plan = []
+    for fit_era, predict_era in cv.split(np.arange(len(eras))):
+        plan.append((_join_eras(eras, fit_era),
+                     _join_eras(eras, predict_era)))
+    return plan
+
+
+def _stratified_cv_plan(index, y, kfold, seed):
+    "Plan of k-fold cross validation of rows `index`, balancing targets `y`"
+    cv = StratifiedKFold(n_splits=kfold, random_state=seed, shuffle=True)
+    plan = []
+    # only y is used to make the folds; x is a placeholder
+    for fit_index, predict_index in cv.split(np.zeros(y.size), y):
+        plan.append((index[fit_index], index[predict_index]))
+    return plan
+
+
+def _era_index(data, train_only=True):
+    """
+    List of the row positions of each era in data (or in train data).
+
+    Eras are listed in order of first appearance, as in `data.unique_era`;
+    rows within an era are in data order. Eras are found with a single
+    stable sort of the era column.
+    """
+    if train_only:
+        index = _region_index(data, ['train'])
+    else:
+        index = np.arange(len(data))
+    if index.size == 0:
+        return []
+    era = data.era_float[index]
+    order = np.argsort(era, kind='mergesort')
+    era = era[order]
+    starts = np.flatnonzero(np.r_[True, era[1:] != era[:-1]])
+    eras = np.split(index[order], starts[1:])
+    eras.sort(key=lambda e: e[0])
+    return eras
+
+
+def _join_eras(eras, idx):
+    "Sorted row positions of the eras at positions `idx` of list `eras`"
+    if len(idx) == 0:
+        return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate([eras[i] for i in idx]))
+
+
+def _era_offsets(eras):
+    """
+    Row offsets of eras if each era is a contiguous run of rows, else None.
+
+    Era i is rows offsets[i]:offsets[i + 1] of data. Eras must also follow
+    one another in data for offsets to be returned.
+    """
+    if len(eras) == 0:
+        return None
+    first = np.array([e[0] for e in eras])
+    last = np.array([e[-1] for e in eras])
+    size = np.array([e.size for e in eras])
+    if (last - first + 1 != size).any() or (first[1:] != last[:-1] + 1).any():
+        return None
+    return np.append(first, last[-1] + 1)
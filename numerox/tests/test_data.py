@@ -146,6 +146,17 @@ def test_data_hash():
     ok_(d2.hash() == d2.hash(), "data.hash not reproduceable")
 
 
+def test_data_digest():
+    "test data.digest"
+    d = micro_data()
+    ok_(d.digest() == d.copy().digest(), "data.digest not reproduceable")
+    d2 = nx.Data(d.df[::2])
+    ok_(d2.digest() != d.digest(), "different data with same digest")
+    d2 = d.copy()
+    d2.df.iloc[0, 2] += 1
+    ok_(d2.digest() != d.digest(), "different values with same digest")
+
+
 def test_empty_data():
     "test empty data"
     d = micro_data()
@@ -257,6 +268,15 @@ def test_data_region_iter():
         ok_(region2 == region, "region difference found")
 
 
+def test_data_region_view():
+    "test data._region_view"
+    d = micro_data()
+    for regions in (['train'], ['validation'], ['test', 'live'],
+                    ['train', 'live']):
+        d2 = d._region_view(regions)
+        ok_(d2 == d.region_isin(regions), "region view is wrong")
+
+
 def test_data_repr():
     "make sure data__repr__() runs"
     d = micro_data()
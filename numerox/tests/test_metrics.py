@@ -1,8 +1,21 @@
+import numpy as np
+import pandas as pd
+from nose.tools import ok_
 from nose.tools import assert_raises
 
+import numerox as nx
 from numerox import testing
 from numerox.metrics import metrics_per_era
 from numerox.metrics import metrics_per_name
+from numerox.metrics import logloss_per_era
+from numerox.metrics import logloss_metrics
+from numerox.metrics import concordance
+from numerox.metrics import CONCORDANCE_CACHE
+from numerox.metrics import pearsonr
+from numerox.metrics import pearsonr_matrix
+from numerox.metrics import ks_2samp
+from numerox.metrics import ks_2samp_matrix
+from numerox.metrics import fraction_bested
 
 
 def test_metrics_per_era():
@@ -17,6 +30,36 @@ def test_metrics_per_era():
         metrics_per_era(d, p, era_as_str=True)
 
 
+def test_logloss_per_era():
+    "logloss_per_era must match metrics_per_era"
+    d = testing.play_data()['validation']
+    rs = np.random.RandomState(0)
+    y = 0.45 + 0.1 * rs.rand(len(d), 3)
+    p = nx.Prediction(pd.DataFrame(data=y, index=d.df.index,
+                                   columns=['m0', 'm1', 'm2']))
+    df = logloss_per_era(d, p)
+    m, regions = metrics_per_era(d, p, columns=['logloss'])
+    for name in p.names:
+        mi = m[m.name == name].set_index('era')['logloss']
+        np.testing.assert_almost_equal(df[name].values,
+                                       mi.loc[df.index].values)
+
+
+def test_logloss_metrics():
+    "logloss_metrics must match metrics_per_name with an unpredicted era"
+    d = testing.play_data()['validation']
+    rs = np.random.RandomState(0)
+    y = 0.45 + 0.1 * rs.rand(len(d), 2)
+    y[d.era == d.unique_era()[0]] = np.nan
+    p = nx.Prediction(pd.DataFrame(data=y, index=d.df.index,
+                                   columns=['m0', 'm1']))
+    columns = ['logloss', 'sharpe', 'consis']
+    m = logloss_metrics(logloss_per_era(d, p))
+    m2, _ = metrics_per_name(d, p, columns=columns)
+    np.testing.assert_allclose(m[columns].values,
+                               m2[columns].values.astype(np.float64))
+
+
 def test_metrics_per_name():
     "make sure metrics_per_name runs"
     d = testing.micro_data()
@@ -25,3 +68,64 @@ def test_metrics_per_name():
     metrics_per_name(d, p, join='yhat')
     metrics_per_name(d, p, columns=['sharpe'])
     assert_raises(ValueError, metrics_per_name, d, p, 'data', ['wtf'])
+
+
+def test_metrics_per_name_bootstrap():
+    "bootstrap confidence intervals should contain the point estimates"
+    d = testing.play_data()['validation']
+    rs = np.random.RandomState(0)
+    p = nx.Prediction(pd.DataFrame(data={'model1': rs.rand(len(d))},
+                                   index=d.df.index))
+    columns = ['logloss', 'sharpe', 'consis']
+    df, info = metrics_per_name(d, p, columns=columns, bootstrap=200)
+    for col in columns:
+        ok_((df[col + '_lo'] <= df[col]).all(), 'lower bound too high')
+        ok_((df[col + '_hi'] >= df[col]).all(), 'upper bound too low')
+
+
+def test_concordance():
+    "concordance should not depend on n_jobs or on the cluster cache"
+    d = testing.play_data()
+    p = nx.production(nx.logistic(), d, 'model1', verbosity=0)
+    p += nx.production(nx.logistic(1e-5), d, 'model2', verbosity=0)
+    df1 = concordance(d, p)
+    ok_(d.digest() in CONCORDANCE_CACHE, 'clusters were not cached')
+    df2 = concordance(d, p, n_jobs=2)
+    pd.testing.assert_frame_equal(df1, df2)
+
+
+def test_pairwise_matrices():
+    "pairwise matrices should match pairwise calls of pearsonr, ks_2samp"
+    rs = np.random.RandomState(0)
+    y1 = rs.rand(100, 3)
+    y2 = rs.rand(100, 4)
+    y2[:, 0] = y1[:, 0]
+    corr = pearsonr_matrix(y1, y2)
+    ks = ks_2samp_matrix(y1, y2)
+    for n_jobs in (1, 2):
+        ks2 = ks_2samp_matrix(y1, y2, n_jobs=n_jobs)
+        np.testing.assert_array_equal(ks, ks2)
+    for i in range(y1.shape[1]):
+        for j in range(y2.shape[1]):
+            c = pearsonr(y1[:, i], y2[:, j])
+            k = ks_2samp(y1[:, i], y2[:, j])
+            np.testing.assert_almost_equal(corr[i, j], c)
+            np.testing.assert_almost_equal(ks[i, j], k)
+
+
+def test_fraction_bested():
+    "fraction_bested should match a brute force calculation"
+    rs = np.random.RandomState(0)
+    a = rs.randint(0, 5, size=(20, 6)).astype(np.float64)
+    a[rs.rand(*a.shape) < 0.1] = np.nan
+    n = a.shape[1] - 1.0
+    for lower_is_better in (True, False):
+        desired = np.zeros(a.shape)
+        for j in range(a.shape[1]):
+            aj = a[:, j].reshape(-1, 1)
+            if lower_is_better:
+                desired[:, j] = (aj < a).sum(axis=1) / n
+            else:
+                desired[:, j] = (aj > a).sum(axis=1) / n
+        actual = fraction_bested(a, lower_is_better)
+        np.testing.assert_almost_equal(actual, desired)
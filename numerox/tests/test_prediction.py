@@ -1,3 +1,5 @@
+import os
+import shutil
 import tempfile
 
 import numpy as np
@@ -7,7 +9,10 @@ from nose.tools import assert_raises
 
 import numerox as nx
 from numerox import testing
+from numerox import prediction
 from numerox.testing import assert_data_equal as ade
+from numerox.testing import shares_memory
+from numerox.prediction import PredictionBuilder
 
 
 def test_empty_prediction():
@@ -60,6 +65,103 @@ def test_prediction_save():
         p2.save(temp.name, mode='a')
         p12 = nx.load_prediction(temp.name)
         ade(p, p12, "prediction corrupted during roundtrip")
+        p2 = nx.load_prediction(temp.name, names=['model2', 'model0'])
+        ade(p[['model2', 'model0']], p2, "loading names failed")
+        p2 = nx.load_prediction(temp.name, names='model1')
+        ade(p['model1'], p2, "loading a name failed")
+        assert_raises(ValueError, nx.load_prediction, temp.name, 'modelX')
+
+    # append rows to names already in archive
+    p1 = testing.micro_prediction([0, 1, 2, 3])
+    p2 = testing.micro_prediction([4, 5, 6, 7, 8, 9])
+    with tempfile.NamedTemporaryFile() as temp:
+        p1.save(temp.name)
+        p2['model0'].save(temp.name, mode='a')
+        p2[['model1', 'model2']].save(temp.name, mode='a')
+        p12 = nx.load_prediction(temp.name)
+        ade(p, p12, "prediction corrupted during roundtrip")
+        assert_raises(ValueError, p2.save, temp.name, mode='a')
+
+    # replace a name already in archive
+    p = testing.micro_prediction()
+    p1 = testing.micro_prediction([0, 1, 2])
+    p1 = p1.ynew(p1.y + 0.5)
+    with tempfile.NamedTemporaryFile() as temp:
+        p.save(temp.name)
+        p1['model1'].save(temp.name, mode='a', replace=True)
+        p2 = nx.load_prediction(temp.name)
+        ade(p2[['model0', 'model2']], p[['model0', 'model2']],
+            "replace changed other names")
+        ade(nx.Prediction(p2['model1'].df.dropna()), p1['model1'],
+            "name was not replaced")
+        p['model1'].save(temp.name, mode='a', replace=True)
+        ade(nx.load_prediction(temp.name), p, "name was not replaced")
+
+    # overwriting a prediction keeps the other keys of the hdf file
+    p = testing.micro_prediction()
+    with tempfile.NamedTemporaryFile() as temp:
+        other = pd.DataFrame({'x': [1.0, 2.0]})
+        other.to_hdf(temp.name, 'other')
+        p.save(temp.name)
+        p['model1'].save(temp.name)
+        ade(nx.load_prediction(temp.name), p['model1'],
+            "prediction was not overwritten")
+        ok_(pd.read_hdf(temp.name, 'other').equals(other),
+            "saving deleted an unrelated key")
+
+
+def test_prediction_save_mmap():
+    "test prediction.save_mmap and load_prediction_mmap"
+    p = testing.micro_prediction()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        p['model0'].save_mmap(tmpdir)
+        p12 = p[['model1', 'model2']].loc[['index3', 'index1']]
+        p12.save_mmap(tmpdir, mode='a')
+        p2 = nx.load_prediction_mmap(tmpdir)
+        p3 = p.copy()
+        idx = ~p3.df.index.isin(['index1', 'index3'])
+        p3.df.loc[idx, ['model1', 'model2']] = np.nan
+        ade(p2, p3, "prediction corrupted during roundtrip")
+        assert_raises(ValueError, p['model0'].save_mmap, tmpdir, mode='a')
+        p4 = nx.Prediction(pd.DataFrame({'model3': [0.5]}, index=['indexX']))
+        assert_raises(ValueError, p4.save_mmap, tmpdir, mode='a')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prediction_chunks():
+    "streaming over chunks of names must give the same results"
+    d = nx.play_data()
+    rs = np.random.RandomState(0)
+    y = 0.45 + 0.1 * rs.rand(len(d), 5)
+    p = nx.Prediction(pd.DataFrame(y, index=d.df.index,
+                                   columns=['m0', 'm1', 'm2', 'm3', 'm4']))
+    v = d['validation']
+    methods = [lambda: p.performance(v),
+               lambda: p.dominance(v),
+               lambda: p.correlation(),
+               lambda: p.correlation('m2', data=v),
+               lambda: p.originality(['m0', 'm1'])]
+    # rows that are NaN in one name are dropped from all names
+    y = y.copy()
+    y[rs.rand(len(d)) < 0.3, 1] = np.nan
+    pnan = nx.Prediction(pd.DataFrame(y, index=d.df.index,
+                                      columns=p.names))
+    methods += [lambda: pnan.performance(v),
+                lambda: pnan.dominance(v)]
+    dfs = [m() for m in methods]
+    chunk_nbytes = prediction.CHUNK_NBYTES
+    prediction.CHUNK_NBYTES = 2 * 8 * len(d)
+    try:
+        for df, m in zip(dfs, methods):
+            df2 = m()
+            df2 = df2.loc[df.index, df.columns]
+            np.testing.assert_almost_equal(df.values.astype(np.float64),
+                                           df2.values.astype(np.float64),
+                                           decimal=6)
+    finally:
+        prediction.CHUNK_NBYTES = chunk_nbytes
 
 
 def test_prediction_to_csv():
@@ -74,6 +176,68 @@ def test_prediction_to_csv():
     assert_raises(ValueError, p.to_csv, 'unused')
 
 
+def test_prediction_to_csv_format():
+    "prediction.to_csv must match pandas formatting"
+    y = np.array([0.5, np.nan, -0.25, 0.9999996, 0.0000004, 12.125])
+    ids = ['id{}'.format(i) for i in range(y.size)]
+    p = nx.Prediction(pd.DataFrame({'model1': y}, index=ids))
+    for decimals in (0, 2, 6):
+        df = p.df.iloc[:, 0].to_frame('probability')
+        df.index.rename('id', inplace=True)
+        txt = df.to_csv(float_format='%.{}f'.format(decimals))
+        ok_(p.to_csv(decimals=decimals) == txt, "to_csv format is wrong")
+
+
+def test_prediction_to_csv_format_random():
+    "prediction.to_csv must match pandas formatting byte for byte, even ties"
+    rs = np.random.RandomState(0)
+    for decimals in (0, 1, 2, 6, 7):
+        for y in (rs.rand(5000), np.round(rs.rand(5000), 7),
+                  np.round(rs.rand(5000), decimals + 1),
+                  np.arange(-1000, 1000) / 20.0):
+            ids = ['id{}'.format(i) for i in range(y.size)]
+            p = nx.Prediction(pd.DataFrame({'model1': y}, index=ids))
+            df = p.df.iloc[:, 0].to_frame('probability')
+            df.index.rename('id', inplace=True)
+            txt = df.to_csv(float_format='%.{}f'.format(decimals))
+            ok_(p.to_csv(decimals=decimals) == txt, "to_csv format is wrong")
+
+
+def test_prediction_to_csv_dir():
+    "make sure prediction.to_csv_dir runs"
+    p = testing.micro_prediction()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for compress in (False, True):
+            paths = p.to_csv_dir(tmpdir, compress=compress, n_jobs=2)
+            ok_(len(paths) == p.shape[1], "wrong number of files")
+            for path, name in zip(paths, p.names):
+                ok_(path.endswith('.csv.gz' if compress else '.csv'),
+                    "wrong file extension")
+                p2 = nx.load_prediction_csv(path, name)
+                ade(p2, p[name], "prediction corrupted during roundtrip")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_load_predictions_csv():
+    "test load_predictions_csv"
+    p = testing.micro_prediction()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = p.to_csv_dir(tmpdir)
+        p2 = nx.load_predictions_csv(os.path.join(tmpdir, '*.csv'), n_jobs=2)
+        ade(p2, p, "prediction corrupted during roundtrip")
+        names = ['a' + name for name in p.names]
+        p2 = nx.load_predictions_csv(paths, names=names)
+        ok_(p2.names == names, "wrong names")
+        assert_raises(ValueError, nx.load_predictions_csv, paths, ['a'])
+        assert_raises(IOError, nx.load_predictions_csv,
+                      os.path.join(tmpdir, '*.unused'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def test_prediction_copies():
     "prediction properties should be copies"
     p = testing.micro_prediction()
@@ -210,6 +374,11 @@ def test_prediction_originality():
     p = testing.micro_prediction()
     df = p.originality(['model1'])
     ok_(isinstance(df, pd.DataFrame), 'expecting a dataframe')
+    df = p.originality([])
+    ok_(df.index.tolist() == p.names, 'expecting all names')
+    ok_((df['corr'] == -np.inf).all(), 'corr should be -inf')
+    ok_((df['ks'] == np.inf).all(), 'ks should be inf')
+    ok_(df['original'].all(), 'all names should be original')
 
 
 def test_prediction_check():
@@ -219,13 +388,30 @@ def test_prediction_check():
     p += nx.production(nx.logisticPCA(), d, verbosity=0)
     df = p.check(['logistic'], d)
     ok_(isinstance(df, pd.DataFrame), 'expecting a dataframe')
+    df2, timings = p.check(['logistic'], d, n_jobs=1, timing=True)
+    pd.testing.assert_frame_equal(df, df2)
+    ok_(isinstance(timings, pd.Series), 'expecting a series')
+    ok_((timings >= 0).all(), 'timings must be non-negative')
+    df = p.check([], d)
+    ok_(df.index.tolist() == p.names, 'first submission should check all')
+    ok_(df['corrTF'].all() and df['ksTF'].all(), 'all should be original')
 
 
 def test_prediction_correlation():
-    "make sure prediction.correlation runs"
+    "test prediction.correlation"
     p = testing.micro_prediction()
-    with testing.HiddenPrints():
-        p.correlation()
+    p = p.ynew(np.random.RandomState(0).rand(*p.shape))
+    corr = np.corrcoef(p.y.T)
+    df = p.correlation()
+    np.testing.assert_almost_equal(df.values, corr, decimal=5)
+    df = p.correlation(chunksize=3)
+    np.testing.assert_almost_equal(df.values, corr, decimal=5)
+    df = p.correlation('model1')
+    ok_(df.index.tolist() == ['model0', 'model2'], 'wrong sort order')
+    df = p.correlation(data=testing.micro_data())
+    ok_(df.shape == (3, 3), 'wrong shape')
+    df = p.top_correlation(k=2)
+    ok_(df.loc['model1', 'name1'] == 'model0', 'wrong top correlation')
 
 
 def test_prediction_concordance():
@@ -292,6 +478,19 @@ def test_prediction_iter():
         ok_(len(n) == 1, 'should only yield a single name')
         names.append(n[0])
     ok_(p.names == names, 'prediction.iter failed')
+    for pi, name in zip(p.iter(copy=False), p.names):
+        ade(pi, p[name], "prediction.iter view is wrong")
+        ok_(shares_memory(p, pi.y), "expecting a view")
+
+
+def test_prediction_column():
+    "test prediction.column"
+    p = testing.micro_prediction()
+    for j, name in enumerate(p.names):
+        y = p.column(name)
+        np.testing.assert_array_equal(y, p.y[:, j])
+        ok_(shares_memory(p, y), "prediction.column should be a view")
+    assert_raises(ValueError, nx.Prediction().column, 'model1')
 
 
 def test_prediction_repr():
@@ -334,3 +533,71 @@ def test_merge_predictions():
     p22 = p2[['model1', 'model2']]
     p12 = nx.merge_predictions([p11, p21, p22, p12])
     ade(p12, p, 'corruption of merge predictions')
+
+    # missing values do not count as overlap
+    p1 = testing.micro_prediction()
+    p2 = testing.micro_prediction()
+    p1.df.iloc[:5] = np.nan
+    p2.df.iloc[5:] = np.nan
+    p12 = nx.merge_predictions([p1, p2])
+    ade(p12, p, 'corruption of merge predictions')
+    p2.df.iloc[5] = 0.5
+    assert_raises(ValueError, nx.merge_predictions, [p1, p2])
+
+
+def test_index_equal():
+    "_index_equal must compare ids by value, not only by address"
+    ids = np.array(['id{}'.format(i) for i in range(200)], dtype=object)
+    same = pd.Index(ids.copy())
+    copied = pd.Index(np.array([i + '' for i in ids.astype(str)],
+                               dtype=object))
+    changed = ids.copy()
+    changed[150] = 'idX'
+    index = pd.Index(ids)
+    ok_(prediction._index_equal(index, same), "same ids should be equal")
+    ok_(prediction._index_equal(index, copied), "equal ids should be equal")
+    ok_(not prediction._index_equal(index, pd.Index(changed)),
+        "different ids should not be equal")
+    ok_(not prediction._index_equal(index, pd.Index(ids[::-1])),
+        "different order should not be equal")
+
+
+def test_prediction_builder():
+    "PredictionBuilder should give the same prediction as merge_arrays"
+    d = testing.micro_data()
+    p = nx.Prediction()
+    builder = PredictionBuilder('model1', nrows=2)
+    ok_(builder.prediction() == p, 'expecting empty prediction')
+    for index in ([9, 4, 3], [2, 0], [1, 8, 7, 6, 5]):
+        ids = d.ids[index]
+        y = d.y[index]
+        p = p.merge_arrays(ids, y, 'model1')
+        builder.append(ids, y)
+        ade(builder.prediction(), p, 'PredictionBuilder failed')
+    builder.append(d.ids[[0]], d.y[[0]])
+    assert_raises(ValueError, builder.prediction)
+
+
+def test_prediction_dtype():
+    "test storage dtype of predictions"
+    p = testing.micro_prediction()
+    p32 = nx.Prediction(p.df, dtype=np.float32)
+    ok_((p32.df.dtypes == np.float32).all(), 'wrong dtype')
+    p1 = p32[['model0']]
+    p2 = p32[['model1', 'model2']]
+    ok_((p1.merge(p2).df.dtypes == np.float32).all(), 'wrong dtype')
+    ok_((p1.merge(p[['model1']]).df.dtypes == np.float64).all(), 'bad dtype')
+    p12 = p1.merge(p[['model1']], dtype=np.float32)
+    ok_((p12.df.dtypes == np.float32).all(), 'wrong dtype')
+    with tempfile.NamedTemporaryFile() as temp:
+        p.save(temp.name, dtype=np.float16)
+        p2 = nx.load_prediction(temp.name)
+        ok_((p2.df.dtypes == np.float32).all(), 'wrong dtype')
+        np.testing.assert_almost_equal(p2.y, p.y, decimal=3)
+        p2 = nx.load_prediction(temp.name, dtype=np.float64)
+        ok_((p2.df.dtypes == np.float64).all(), 'wrong dtype')
+    d = testing.micro_data()
+    df1 = p.performance(d)
+    df2 = p32.performance(d)
+    np.testing.assert_almost_equal(df1.values.astype(np.float64),
+                                   df2.values.astype(np.float64), decimal=4)
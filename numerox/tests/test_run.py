@@ -1,6 +1,17 @@
+import time
+import shutil
+import tempfile
+
+from nose.tools import ok_
+from nose.tools import assert_raises
+
+import numpy as np
+
 import numerox as nx
 from numerox import testing
 from numerox.model import fifty
+from numerox.metrics import LOGLOSS_BENCHMARK
+from numerox.run import _binomial_tail, _worse_than_benchmark
 
 
 def test_run():
@@ -27,3 +38,178 @@ def test_backtest_production():
             nx.production(model, d, verbosity=verbosity)
             if verbosity == 3:
                 nx.production(model, d, name='test', verbosity=verbosity)
+
+
+def test_run_n_jobs():
+    "run with n_jobs > 1 must give the same prediction as n_jobs=1"
+    d = testing.play_data()
+    model = nx.logistic()
+    p = nx.backtest(model, d, kfold=3, verbosity=0)
+    for executor in ('process', 'thread'):
+        p2 = nx.backtest(model, d, kfold=3, verbosity=0, n_jobs=2,
+                         executor=executor)
+        ok_(p2 == p, "n_jobs changed the prediction")
+    assert_raises(ValueError, nx.backtest, model, d, verbosity=0, n_jobs=2,
+                  executor='cluster')
+
+
+def test_run_many():
+    "run_many must give the same prediction as run"
+    d = testing.play_data()
+    models = [nx.logistic(), fifty()]
+    p = nx.Prediction()
+    for model in models:
+        p += nx.run(model, nx.CVSplitter(d, kfold=2), verbosity=0)
+    for n_jobs in (1, 2):
+        splitter = nx.CVSplitter(d, kfold=2)
+        p2 = nx.run_many(models, splitter, verbosity=0, n_jobs=n_jobs)
+        ok_(p2 == p, "run_many and run differ")
+    splitter = nx.TournamentSplitter(d)
+    with testing.HiddenPrints():
+        nx.run_many(models, splitter, names=['a', 'b'], verbosity=2)
+    assert_raises(ValueError, nx.run_many, [fifty(), fifty()], splitter)
+
+
+def test_run_checkpoint():
+    "run with a checkpoint should resume and give the same prediction"
+    d = testing.play_data()
+    p = nx.backtest(nx.logistic(), d, kfold=3, verbosity=0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        model = FailingModel(nfit=2)
+        assert_raises(RuntimeError, nx.backtest, model, d, kfold=3,
+                      verbosity=0, checkpoint=tmpdir)
+        model = FailingModel(nfit=1)
+        p2 = nx.backtest(model, d, 'logistic', kfold=3, verbosity=0,
+                         checkpoint=tmpdir)
+        ok_(p2 == p, "checkpoint changed the prediction")
+        model = FailingModel(nfit=0)
+        p2 = nx.backtest(model, d, 'logistic', kfold=3, verbosity=0,
+                         checkpoint=tmpdir)
+        ok_(p2 == p, "checkpoint changed the prediction")
+        assert_raises(ValueError, nx.backtest, PlainModel(), d, kfold=3,
+                      verbosity=0, checkpoint=tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_run_timing():
+    "run with timing=True should return the same prediction and a report"
+    d = testing.play_data()
+    splitter = nx.CVSplitter(d, kfold=2)
+    p = nx.run(nx.logistic(), splitter, verbosity=0)
+    for n_jobs, executor in ((1, 'process'), (2, 'process'), (2, 'thread')):
+        splitter = nx.CVSplitter(d, kfold=2)
+        p2, report = nx.run(nx.logistic(), splitter, verbosity=0,
+                            n_jobs=n_jobs, executor=executor, timing=True)
+        ok_(p2 == p, "timing changed the prediction")
+        ok_(list(report.columns) == ['fold', 'stage', 'wall', 'cpu', 'rss'],
+            "wrong report columns")
+        stages = report.stage[report.fold == 0].tolist()
+        ok_(stages == ['split', 'y_to_nan', 'fit_predict', 'append'],
+            "wrong stages")
+        ok_(report.stage.tolist()[-2:] == ['prediction', 'total'],
+            "wrong final stages")
+        ok_((report.wall >= 0).all(), "negative wall time")
+
+
+class FailingModel(nx.logistic):
+    "logistic model that raises once it has been fit `nfit` times"
+
+    def __init__(self, nfit):
+        nx.logistic.__init__(self)
+        self.nfit = nfit
+
+    def fit_predict(self, dfit, dpre):
+        if self.nfit == 0:
+            raise RuntimeError("too many fits")
+        self.nfit -= 1
+        return nx.logistic.fit_predict(self, dfit, dpre)
+
+
+def test_run_budget():
+    "run must cancel folds that run out of time"
+    d = testing.play_data()
+    p = nx.backtest(nx.logistic(), d, kfold=3, verbosity=0)
+    ok_(not p.partial, "prediction should not be partial")
+    slow_id = d['train'].ids[0]
+    model = SlowModel(slow_id)
+    p2 = nx.backtest(model, d, 'logistic', kfold=3, verbosity=0,
+                     fold_timeout=2)
+    ok_(p2.partial, "prediction should be partial")
+    ok_(slow_id not in p2.ids, "slow fold should be cancelled")
+    ok_(0 < len(p2) < len(p), "only the slow fold should be cancelled")
+    ok_((p2.df == p.df.loc[p2.ids]).all().all(), "finished folds differ")
+    p2 = nx.backtest(SlowModel(None), d, kfold=3, verbosity=0, n_jobs=2,
+                     timeout=0.5)
+    ok_(p2.partial and len(p2) == 0, "all folds should be cancelled")
+    with testing.HiddenPrints():
+        p2 = nx.production(nx.logistic(), d, verbosity=1, timeout=60)
+    ok_(not p2.partial, "prediction should not be partial")
+    assert_raises(ValueError, nx.backtest, nx.logistic(), d, verbosity=0,
+                  executor='thread', n_jobs=2, timeout=60)
+
+
+def test_run_early_stop():
+    "run must stop early when logloss is worse than benchmark"
+    d = testing.play_data()
+    p = nx.backtest(nx.logistic(), d, kfold=3, verbosity=0)
+    p2 = nx.backtest(nx.logistic(), d, kfold=3, verbosity=0,
+                     early_stop=0.01)
+    ok_(p2 == p and not p2.partial, "early_stop changed the prediction")
+    with testing.HiddenPrints():
+        p2 = nx.backtest(ConstantModel(), d, kfold=3, verbosity=2,
+                         early_stop=0.01)
+    ok_(p2.partial, "prediction should be partial")
+    ok_(0 < len(p2) < len(p), "only the first fold should be predicted")
+
+
+def test_worse_than_benchmark():
+    "sign test must be exact for few eras and not overflow for many"
+    for n, k in ((1, 1), (10, 8), (20, 3), (30, 30)):
+        exact = sum(comb(n, i) for i in range(k, n + 1)) / 2.0 ** n
+        np.testing.assert_allclose(_binomial_tail(n, k), exact)
+    b = LOGLOSS_BENCHMARK
+    era_logloss = [np.array([b + 0.01] * 1100 + [b - 0.01] * 900)]
+    ok_(_worse_than_benchmark(era_logloss, 0.01), "should be worse")
+    era_logloss = [np.array([b + 0.01] * 1000 + [b - 0.01] * 1000)]
+    ok_(not _worse_than_benchmark(era_logloss, 0.01),
+        "should not be worse")
+
+
+def comb(n, k):
+    "Number of ways to choose k items from n"
+    c = 1
+    for i in range(min(k, n - k)):
+        c = c * (n - i) // (i + 1)
+    return c
+
+
+class SlowModel(nx.logistic):
+    "logistic model that sleeps when it predicts `slow_id` (or, if None, any)"
+
+    def __init__(self, slow_id):
+        nx.logistic.__init__(self)
+        self.slow_id = slow_id
+
+    def fit_predict(self, dfit, dpre):
+        if self.slow_id is None or self.slow_id in dpre.ids:
+            time.sleep(60)
+        return nx.logistic.fit_predict(self, dfit, dpre)
+
+
+class ConstantModel(nx.Model):
+    "model that predicts a bad constant"
+
+    def __init__(self):
+        self.p = {}
+
+    def fit_predict(self, dfit, dpre):
+        return dpre.ids, 0.9 * np.ones(len(dpre))
+
+
+class PlainModel(object):
+    "model that does not subclass nx.Model so its repr has an address"
+
+    def fit_predict(self, dfit, dpre):
+        return dpre.ids, 0.5 * np.ones(len(dpre))
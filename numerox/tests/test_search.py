@@ -0,0 +1,155 @@
+import time
+import shutil
+import tempfile
+
+from nose.tools import ok_
+from nose.tools import assert_raises
+
+import numpy as np
+import pandas as pd
+
+import numerox as nx
+from numerox import testing
+from numerox.metrics import logloss_per_era, logloss_metrics
+from numerox.model import fifty
+
+
+def test_sweep():
+    "sweep must give the same prediction and metrics as run"
+    d = testing.play_data()
+    grid = {'inverse_l2': [1e-4, 1e-2]}
+    p = nx.Prediction()
+    for inverse_l2 in grid['inverse_l2']:
+        model = nx.logistic(inverse_l2)
+        splitter = nx.CVSplitter(d, kfold=2)
+        p += nx.run(model, splitter, repr(model), verbosity=0)
+    pivot = logloss_per_era(d['train'], p)
+    metrics = logloss_metrics(pivot)
+    for n_jobs, executor in ((1, 'process'), (2, 'process'), (2, 'thread')):
+        splitter = nx.CVSplitter(d, kfold=2)
+        m, p2 = nx.sweep(nx.logistic, grid, splitter, n_jobs=n_jobs,
+                         executor=executor, keep_prediction=True,
+                         verbosity=0)
+        ok_(p2 == p, "sweep and run differ")
+        ok_(m.index.tolist() == p.names, "wrong metrics index")
+        ok_((m['inverse_l2'].values == grid['inverse_l2']).all(),
+            "wrong parameter column")
+        np.testing.assert_allclose(m[metrics.columns].values, metrics.values)
+    rows = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for stage in ('fit_predict', 'load'):
+            splitter = nx.CVSplitter(d, kfold=2)
+            m2, report = nx.sweep(nx.logistic, grid, splitter,
+                                  callback=rows.append, checkpoint=tmpdir,
+                                  timing=True, verbosity=0)
+            pd.testing.assert_frame_equal(m2, m)
+            ok_((report.stage == stage).all(), "wrong timing report")
+            ok_(len(report) == 4, "expecting one row per task")
+    finally:
+        shutil.rmtree(tmpdir)
+    pd.testing.assert_frame_equal(pd.concat(rows[:2]), m)
+    splitter = nx.TournamentSplitter(d)
+    with testing.HiddenPrints():
+        m = nx.sweep(nx.logistic, [{'inverse_l2': [1e-4]}], splitter,
+                     verbosity=2)
+    ok_(m.shape == (1, 4), "wrong metrics shape")
+    assert_raises(ValueError, nx.sweep, fifty, [{}, {}], splitter)
+
+
+def test_sweep_timeout():
+    "sweep must report configurations whose folds were all cancelled"
+    d = testing.play_data()
+    splitter = nx.CVSplitter(d, kfold=2)
+    rows = []
+    with testing.HiddenPrints():
+        m = nx.sweep(SleepModel, {'seconds': [0, 60]}, splitter,
+                     callback=rows.append, timeout=3)
+    ok_(len(rows) == 2, "expecting one callback per configuration")
+    pd.testing.assert_frame_equal(pd.concat(rows), m)
+    ok_(m['logloss'].notnull().tolist() == [True, False],
+        "only the cancelled configuration should have NaN metrics")
+
+
+def test_param_list():
+    "param_list must give every combination"
+    params = nx.search.param_list({'a': [1, 2], 'b': [3, 4, 5]})
+    ok_(len(params) == 6, "wrong number of combinations")
+    ok_(params[0] == {'a': 1, 'b': 3}, "wrong first combination")
+    params = nx.search.param_list([{'a': [1]}, {'b': [2, 3]}])
+    ok_(params == [{'a': 1}, {'b': 2}, {'b': 3}], "wrong list of grids")
+
+
+def test_successive_halving():
+    "successive_halving must promote the best configurations"
+    d = testing.play_data()
+    grid = {'inverse_l2': [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1]}
+    model, report = nx.successive_halving(nx.logistic, grid, d, kfold=3,
+                                          verbosity=0)
+    ok_(report.rung.tolist() == [0] * 6 + [1] * 2,
+        "wrong number of configurations per rung")
+    ok_(report.neras.is_monotonic_increasing, "eras must grow")
+    ok_(report.neras.iloc[-1] == 120, "last rung must use all train eras")
+    ok_(report.kfold.iloc[-1] == 3, "last rung must use kfold folds")
+    r = report[report.rung == 0]
+    best = r.sort_values('logloss').index[:2]
+    ok_(report[report.rung == 1].index.isin(best).all(),
+        "best configurations not promoted")
+    r = report[report.rung == 1]
+    ok_(repr(model) == r.sort_values('logloss').index[0],
+        "winner must be the best finalist on all eras")
+    grid = {'inverse_l2': [1e-4, 1e-2, 1]}
+    model, report = nx.successive_halving(nx.logistic, grid, d, kfold=3,
+                                          verbosity=0)
+    ok_((report.rung == 0).all() and (report.neras == 120).all(),
+        "eta or fewer configurations should all get all eras")
+    with testing.HiddenPrints():
+        nx.successive_halving(nx.logistic, grid, d, kfold=2, eta=4,
+                              metric='sharpe', verbosity=2)
+    assert_raises(ValueError, nx.successive_halving, nx.logistic, grid, d,
+                  metric='auc')
+
+
+def test_run_repeated():
+    "run_repeated must give the metrics of each repeat"
+    d = testing.play_data()
+    metrics = []
+    for seed in range(3):
+        p = nx.run(nx.logistic(), nx.CVSplitter(d, kfold=2, seed=seed),
+                   verbosity=0)
+        metrics.append(logloss_metrics(logloss_per_era(d['train'], p)))
+    for n_jobs in (1, 2):
+        splitter = nx.RepeatedCVSplitter(d, kfold=2, nrepeat=3)
+        m = nx.run_repeated(nx.logistic(), splitter, n_jobs=n_jobs,
+                            verbosity=0)
+        ok_(m.index.tolist() == [0, 1, 2], "wrong index")
+        np.testing.assert_allclose(m.values,
+                                   np.vstack([x.values for x in metrics]))
+    columns = ['logloss', 'auc', 'acc', 'ystd', 'sharpe', 'consis']
+    splitter = nx.RepeatedCVSplitter(d, kfold=2, nrepeat=2)
+    m = nx.run_repeated(nx.logistic(), splitter, columns, verbosity=0)
+    ok_(m.columns.tolist() == columns, "wrong columns")
+    for seed in range(2):
+        p = nx.run(nx.logistic(), nx.CVSplitter(d, kfold=2, seed=seed),
+                   verbosity=0)
+        expected = p.performance(d['train'], columns=columns)
+        np.testing.assert_allclose(m.loc[seed].values,
+                                   expected.values[0].astype(np.float64))
+    assert_raises(TypeError, nx.run, nx.logistic(), splitter, verbosity=0)
+    splitter = nx.RepeatedCVSplitter(d, kfold=2, nrepeat=2, ignore_era=True)
+    with testing.HiddenPrints():
+        nx.run_repeated(fifty(), splitter, verbosity=2)
+    m = nx.run_repeated(SleepModel(), splitter, timeout=0.5, verbosity=0)
+    ok_(m.shape == (2, 3) and m.isnull().all().all(),
+        "repeats that ran out of time should have NaN metrics")
+
+
+class SleepModel(nx.Model):
+    "model that takes too long"
+
+    def __init__(self, seconds=60):
+        self.p = {'seconds': seconds}
+
+    def fit_predict(self, dfit, dpre):
+        time.sleep(self.p['seconds'])
+        return dpre.ids, 0.5 * np.ones(len(dpre))
@@ -1,8 +1,12 @@
+import pickle
+
 from nose.tools import ok_
+from nose.tools import assert_raises
 
 import numpy as np
 
 import numerox as nx
+from numerox.testing import shares_memory
 
 
 def test_splitter_overlap():
@@ -65,3 +69,70 @@ def test_rollsplitter():
         npre = pera.size
         ntot = tera.size
         ok_(nfit + npre == ntot, "RollSplitter has era overalp")
+
+
+def test_rollsplitter_windows():
+    "test rollsplitter windows, expanding mode and row order fallback"
+    d = nx.play_data()
+    eras = d['train'].unique_era()
+    shuffled = nx.Data(d.df.sample(frac=1, random_state=0))
+    shuffled_eras = shuffled['train'].unique_era()
+    for expanding in (False, True):
+        for data, era in ((d, eras), (shuffled, shuffled_eras)):
+            splitter = nx.RollSplitter(data, fit_window=10, predict_window=5,
+                                       step=20, expanding=expanding)
+            count = 0
+            for i, (dfit, dpre) in enumerate(splitter):
+                f1 = 0 if expanding else 20 * i
+                f2 = 20 * i + 10
+                ok_(dfit == data['train'].era_isin(era[f1:f2]),
+                    "wrong fit window")
+                ok_(dpre == data['train'].era_isin(era[f2:f2 + 5]),
+                    "wrong predict window")
+                if data is d:
+                    ok_(shares_memory(d, dfit), "expecting a view")
+                count += 1
+            ok_(count == (era.size - 15) // 20 + 1, "wrong number of splits")
+
+
+def test_splitter_plan():
+    "splitter.plan should be cached, picklable and match the splits"
+    d = nx.play_data()
+    splitters = [nx.TournamentSplitter(d),
+                 nx.ValidationSplitter(d),
+                 nx.CheatSplitter(d),
+                 nx.CVSplitter(d),
+                 nx.IgnoreEraCVSplitter(d),
+                 nx.SplitSplitter(d, fit_fraction=0.5),
+                 nx.RollSplitter(d, fit_window=15, predict_window=10,
+                                 step=15)]
+    for splitter in splitters:
+        plan = splitter.plan()
+        ok_(splitter.plan() is plan, "plan was recomputed")
+        plan2 = pickle.loads(pickle.dumps(plan))
+        splits = list(splitter)
+        ok_(len(plan2) == len(splits), "wrong number of splits in plan")
+        for (fit_index, predict_index), (dfit, dpre) in zip(plan2, splits):
+            ok_((d.ids[fit_index] == dfit.ids).all(), "fit index is wrong")
+            ok_((d.ids[predict_index] == dpre.ids).all(),
+                "predict index is wrong")
+        splitter.reset()
+        ok_(splitter.plan() is plan, "reset recomputed the plan")
+
+
+def test_repeatedcvsplitter():
+    "RepeatedCVSplitter must repeat CVSplitter with increasing seeds"
+    d = nx.play_data()
+    for ignore_era, cls in ((False, nx.CVSplitter),
+                            (True, nx.IgnoreEraCVSplitter)):
+        splitter = nx.RepeatedCVSplitter(d, kfold=3, nrepeat=3, seed=2,
+                                         ignore_era=ignore_era)
+        plans = splitter.repeat_plans()
+        ok_(len(plans) == 3, "wrong number of repeats")
+        ok_(len(splitter.plan()) == 9, "wrong number of splits")
+        assert_raises(TypeError, list, splitter)
+        for i, plan in enumerate(plans):
+            expected = cls(d, kfold=3, seed=2 + i).plan()
+            for (f1, p1), (f2, p2) in zip(plan, expected):
+                ok_((f1 == f2).all() and (p1 == p2).all(),
+                    "repeat differs from single cross validation")